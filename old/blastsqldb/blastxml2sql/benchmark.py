@@ -0,0 +1,491 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# End-to-end benchmark of blastxml2sql. Deterministic synthetic BLAST XML
+# reports, laid out as sqltools/blastin.py walks them, are loaded with
+# 'blast', summarized with 'besthits' and read back with 'retrieval'. Each
+# stage runs as its own process, its time, rows/s, peak RSS and the database
+# size are appended to a results file, one line per stage, and 'compare'
+# sets two runs (e.g. two commits) side by side. 'inserts' times the
+# ways of inserting rows, string-built INSERTs, misctools.insert and
+# misctools.BulkInsert, on their own.
+#
+########################################################
+
+import argparse
+import csv
+import os
+import random
+import shlex
+import shutil
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+from time import strftime, time
+
+import sqltools.misctools as misc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLI = os.path.join(HERE, 'blastxml2sql.py')
+
+RESULT_FIELDS = ('run', 'commit', 'label', 'stage', 'reports', 'queries', 'hits',
+                 'hsps', 'seconds', 'rows', 'rows_per_s', 'peak_rss_mb', 'db_mb')
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+def parse(parser):
+    sub = parser.add_subparsers(
+        title="Benchmark commands",
+        dest="benchmark_function")
+
+    # Shape of the synthetic data, shared by generate and run
+    shape = argparse.ArgumentParser(add_help=False)
+    shape.add_argument(
+        '-q', '--queries',
+        help="queries per report (default=1000)",
+        type=int, default=1000)
+    shape.add_argument(
+        '-t', '--hits',
+        help="hits per query (default=20)",
+        type=int, default=20)
+    shape.add_argument(
+        '-s', '--hsps',
+        help="hsps per hit (default=2)",
+        type=int, default=2)
+    shape.add_argument(
+        '-l', '--align_len',
+        help="minimum and maximum alignment length (default=20 300)",
+        type=int, nargs=2, default=(20, 300))
+    shape.add_argument(
+        '-u', '--subjects',
+        help="number of distinct subjects hits are drawn from (default=10 x queries x hits)",
+        type=int)
+    shape.add_argument(
+        '--seed',
+        help="random seed (default=1)",
+        type=int, default=1)
+
+    gen = sub.add_parser(
+        'generate',
+        parents=[shape],
+        help="Write one synthetic BLAST XML report")
+    gen.add_argument(
+        'output',
+        help="output XML file, '-' for stdout")
+    gen.add_argument(
+        '-d', '--db',
+        help="BLAST database name (default=/data/Species_1.faa)",
+        default='/data/Species_1.faa')
+
+    run = sub.add_parser(
+        'run',
+        parents=[shape],
+        help="Generate reports and time each stage")
+    run.add_argument(
+        '-n', '--reports',
+        help="number of reports, one per database (default=4)",
+        type=int, default=4)
+    run.add_argument(
+        '-r', '--results',
+        help="results file the stages are appended to (default=benchmark.tsv)",
+        default='benchmark.tsv')
+    run.add_argument(
+        '-L', '--label',
+        help="free text label of the run",
+        default='')
+    run.add_argument(
+        '-b', '--blast_options',
+        help="extra options for the blast stage, e.g. --blast_options='-F -p 4'",
+        default='')
+    run.add_argument(
+        '-w', '--workdir',
+        help="directory for reports and database (default: a temporary directory)")
+    run.add_argument(
+        '-k', '--keep',
+        help="keep the reports and database",
+        default=False, action='store_true')
+
+    ins = sub.add_parser(
+        'inserts',
+        help="Time the ways of inserting Hsp rows")
+    ins.add_argument(
+        '-n', '--rows',
+        help="number of rows (default=200000)",
+        type=int, default=200000)
+    ins.add_argument(
+        '--batch_size',
+        help="BulkInsert batch size (default=10000)",
+        type=int, default=10000)
+    ins.add_argument(
+        '-r', '--results',
+        help="results file the timings are appended to (default=benchmark.tsv)",
+        default='benchmark.tsv')
+    ins.add_argument(
+        '-L', '--label',
+        help="free text label of the run",
+        default='')
+
+    cmp = sub.add_parser(
+        'compare',
+        help="Compare two runs of a results file")
+    cmp.add_argument(
+        'results',
+        help="results file")
+    cmp.add_argument(
+        '-a', '--base',
+        help="run, commit or label of the baseline (default: second to last run)")
+    cmp.add_argument(
+        '-c', '--current',
+        help="run, commit or label compared to it (default: last run)")
+
+    parser.set_defaults(func=__dispatch__)
+
+def __dispatch__(args):
+    call = {'generate': __generate__,
+            'run': __run__,
+            'inserts': __inserts__,
+            'compare': __compare__}
+    if(args.benchmark_function is None):
+        print("Please select a benchmark command, see -h")
+        sys.exit(1)
+    call[args.benchmark_function](args)
+
+
+
+# Writes a report with the given shape. The same arguments always give the
+# same report, except for the database name. Alignment strings are slices of
+# one random pool of residues so that generating GBs stays cheap.
+def write_report(out, db, queries=1000, hits=20, hsps=2, align_len=(20, 300),
+                 subjects=None, seed=1):
+    r = random.Random(seed)
+    subjects = subjects or 10 * queries * hits
+    minlen, maxlen = align_len
+    pool = ''.join(r.choice(AMINO_ACIDS) for i in range(4 * maxlen))
+    w = out.write
+    w('<?xml version="1.0"?>\n'
+      '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" '
+      '"http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n'
+      '<BlastOutput>\n'
+      '  <BlastOutput_program>blastp</BlastOutput_program>\n'
+      '  <BlastOutput_version>BLASTP 2.2.28+</BlastOutput_version>\n'
+      '  <BlastOutput_reference>synthetic</BlastOutput_reference>\n'
+      '  <BlastOutput_db>{}</BlastOutput_db>\n'
+      '  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n'
+      '  <BlastOutput_query-def>query_1</BlastOutput_query-def>\n'
+      '  <BlastOutput_query-len>{}</BlastOutput_query-len>\n'
+      '  <BlastOutput_param>\n'
+      '    <Parameters>\n'
+      '      <Parameters_matrix>BLOSUM62</Parameters_matrix>\n'
+      '      <Parameters_expect>10</Parameters_expect>\n'
+      '      <Parameters_gap-open>11</Parameters_gap-open>\n'
+      '      <Parameters_gap-extend>1</Parameters_gap-extend>\n'
+      '      <Parameters_filter>F</Parameters_filter>\n'
+      '    </Parameters>\n'
+      '  </BlastOutput_param>\n'
+      '  <BlastOutput_iterations>\n'.format(db, 2 * maxlen))
+    for q in range(1, queries + 1):
+        query_len = r.randint(maxlen, 2 * maxlen)
+        w('    <Iteration>\n'
+          '      <Iteration_iter-num>{0}</Iteration_iter-num>\n'
+          '      <Iteration_query-ID>Query_{0}</Iteration_query-ID>\n'
+          '      <Iteration_query-def>query_{0} synthetic protein {0}</Iteration_query-def>\n'
+          '      <Iteration_query-len>{1}</Iteration_query-len>\n'
+          '      <Iteration_hits>\n'.format(q, query_len))
+        for h in range(1, hits + 1):
+            subject = r.randrange(subjects)
+            # A subject has the same length in every hit
+            hit_len = maxlen + subject % (maxlen + 1)
+            w('        <Hit>\n'
+              '          <Hit_num>{0}</Hit_num>\n'
+              '          <Hit_id>gi|{1}|ref|XP_{1}.1|</Hit_id>\n'
+              '          <Hit_def>synthetic subject {1}</Hit_def>\n'
+              '          <Hit_accession>XP_{1}</Hit_accession>\n'
+              '          <Hit_len>{2}</Hit_len>\n'
+              '          <Hit_hsps>\n'.format(h, subject, hit_len))
+            for s in range(1, hsps + 1):
+                length = r.randint(minlen, maxlen)
+                start = r.randrange(len(pool) - 2 * length)
+                qseq = pool[start:start + length]
+                hseq = pool[start + length:start + 2 * length]
+                midline = ''.join(a if a == b else ' ' for a, b in zip(qseq, hseq))
+                identity = length - midline.count(' ')
+                qfrom = r.randint(1, query_len - length + 1)
+                hfrom = r.randint(1, hit_len - length + 1)
+                bit_score = r.uniform(20, 2 * length)
+                w('            <Hsp>\n'
+                  '              <Hsp_num>{}</Hsp_num>\n'
+                  '              <Hsp_bit-score>{:.4f}</Hsp_bit-score>\n'
+                  '              <Hsp_score>{}</Hsp_score>\n'
+                  '              <Hsp_evalue>{:.3g}</Hsp_evalue>\n'
+                  '              <Hsp_query-from>{}</Hsp_query-from>\n'
+                  '              <Hsp_query-to>{}</Hsp_query-to>\n'
+                  '              <Hsp_hit-from>{}</Hsp_hit-from>\n'
+                  '              <Hsp_hit-to>{}</Hsp_hit-to>\n'
+                  '              <Hsp_query-frame>0</Hsp_query-frame>\n'
+                  '              <Hsp_hit-frame>0</Hsp_hit-frame>\n'
+                  '              <Hsp_identity>{}</Hsp_identity>\n'
+                  '              <Hsp_positive>{}</Hsp_positive>\n'
+                  '              <Hsp_gaps>0</Hsp_gaps>\n'
+                  '              <Hsp_align-len>{}</Hsp_align-len>\n'
+                  '              <Hsp_qseq>{}</Hsp_qseq>\n'
+                  '              <Hsp_hseq>{}</Hsp_hseq>\n'
+                  '              <Hsp_midline>{}</Hsp_midline>\n'
+                  '            </Hsp>\n'.format(
+                      s, bit_score, int(2.2 * bit_score), r.random() * 10 ** -r.randint(1, 100),
+                      qfrom, qfrom + length - 1, hfrom, hfrom + length - 1,
+                      identity, min(length, identity + r.randint(0, length - identity)),
+                      length, qseq, hseq, midline))
+            w('          </Hit_hsps>\n'
+              '        </Hit>\n')
+        w('      </Iteration_hits>\n'
+          '      <Iteration_stat>\n'
+          '        <Statistics>\n'
+          '          <Statistics_db-num>{}</Statistics_db-num>\n'
+          '          <Statistics_db-len>{}</Statistics_db-len>\n'
+          '          <Statistics_hsp-len>0</Statistics_hsp-len>\n'
+          '          <Statistics_eff-space>0</Statistics_eff-space>\n'
+          '          <Statistics_kappa>0.041</Statistics_kappa>\n'
+          '          <Statistics_lambda>0.267</Statistics_lambda>\n'
+          '          <Statistics_entropy>0.14</Statistics_entropy>\n'
+          '        </Statistics>\n'
+          '      </Iteration_stat>\n'
+          '    </Iteration>\n'.format(10 * queries * hits, 10 * queries * hits * maxlen))
+    w('  </BlastOutput_iterations>\n'
+      '</BlastOutput>\n')
+
+def __generate__(args):
+    shape = __shape__(args)
+    if('-' == args.output):
+        write_report(sys.stdout, args.db, **shape)
+    else:
+        with open(args.output, 'w') as out:
+            write_report(out, args.db, **shape)
+
+def __shape__(args):
+    return({'queries': args.queries, 'hits': args.hits, 'hsps': args.hsps,
+            'align_len': tuple(args.align_len), 'subjects': args.subjects,
+            'seed': args.seed})
+
+
+
+# Runs one blastxml2sql command as a child process. Returns the wall time,
+# the number of lines it printed and its own peak RSS in MB (from wait4, so
+# earlier stages do not count).
+def __time_command__(argv):
+    start = time()
+    proc = subprocess.Popen([sys.executable, CLI] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    lines = sum(1 for line in proc.stdout)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time() - start
+    if(proc.returncode != 0):
+        print("Failed: {}".format(' '.join(argv)))
+        sys.exit(1)
+    return(seconds, lines, usage.ru_maxrss / 1024)
+
+def __count__(db, table):
+    cmd = "SELECT count(*) FROM {}".format(table)
+    out = subprocess.run([sys.executable, CLI, 'retrieval', 'raw', '-H', cmd, db],
+                         stdout=subprocess.PIPE, check=True)
+    return(int(out.stdout))
+
+def __commit__():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return(out.stdout.decode().strip() or 'NA')
+    except OSError:
+        return('NA')
+
+def __run__(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='blastxml2sql-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    db = os.path.join(os.path.abspath(workdir), 'benchmark.db')
+    if(os.path.exists(db)):
+        os.remove(db)
+    # set_db_path only takes paths to existing files as given
+    open(db, 'w').close()
+
+    shape = __shape__(args)
+    start = time()
+    reports = []
+    for i in range(args.reports):
+        report = os.path.join(workdir, 'species_{}.xml'.format(i + 1))
+        with open(report, 'w') as out:
+            write_report(out, '/data/Species_{}.faa'.format(i + 1), **shape)
+        reports.append(report)
+    size = sum(os.path.getsize(x) for x in reports) / 2 ** 20
+    print("Generated {} reports, {:.1f} MB, in {:.1f}s".format(
+          len(reports), size, time() - start), file=sys.stderr)
+
+    stages = [('init', ['init', '-b'], None),
+              ('blast', ['blast'] + shlex.split(args.blast_options) +
+                        [x for report in reports for x in ('-i', report)],
+                        ('BlastOutput', 'Iteration', 'Hit', 'Hsp')),
+              ('besthits', ['besthits', '--all'], ('BestHits',)),
+              ('retrieval_mat', ['retrieval', 'mat'], None),
+              ('retrieval_raw', ['retrieval', 'raw', '-H',
+                                 "SELECT query_def, Subject.accession, Hsp.* " +
+                                 "FROM Hsp INNER JOIN Hit ON Hsp.parent = Hit.sid " +
+                                 "INNER JOIN Subject ON Hit.subject = Subject.sid " +
+                                 "INNER JOIN Iteration ON Hit.parent = Iteration.sid"], None)]
+
+    run = strftime("%Y-%m-%dT%H:%M:%S")
+    common = {'run': run, 'commit': __commit__(), 'label': args.label,
+              'reports': args.reports, 'queries': args.queries,
+              'hits': args.hits, 'hsps': args.hsps}
+    results = []
+    try:
+        for stage, argv, tables in stages:
+            seconds, lines, rss = __time_command__(argv + [db])
+            rows = sum(__count__(db, x) for x in tables) if tables else lines
+            result = dict(common, stage=stage, seconds='{:.3f}'.format(seconds),
+                          rows=rows, rows_per_s='{:.0f}'.format(rows / seconds),
+                          peak_rss_mb='{:.1f}'.format(rss),
+                          db_mb='{:.1f}'.format(os.path.getsize(db) / 2 ** 20))
+            results.append(result)
+            print("{stage}\t{seconds}s\t{rows} rows\t{rows_per_s} rows/s\t"
+                  "{peak_rss_mb} MB peak\t{db_mb} MB db".format(**result),
+                  file=sys.stderr)
+    finally:
+        if(not args.keep):
+            if(args.workdir):
+                for x in reports + [db]:
+                    os.remove(x)
+            else:
+                shutil.rmtree(workdir)
+
+    __write_results__(args.results, results)
+
+def __write_results__(filename, results):
+    new = not os.path.exists(filename)
+    with open(filename, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, delimiter='\t')
+        if(new):
+            writer.writeheader()
+        writer.writerows(results)
+
+
+
+# Inserts as done before parameterized inserts: values quoted into the SQL
+# text and the rowid fetched by a second statement
+def __insert_string__(cur, table, rows):
+    for dic in rows:
+        cur.execute(''.join(("INSERT INTO ", table,
+                             " (", ','.join(dic.keys()), ") ",
+                             " VALUES('", "','".join(map(str, dic.values())), "');")))
+        cur.execute("select last_insert_rowid()")
+        cur.fetchall()
+
+def __insert_param__(cur, table, rows):
+    for dic in rows:
+        misc.insert(dic, table, cur)
+
+def __insert_bulk__(cur, table, rows, batch_size):
+    writer = misc.BulkInsert(cur, batch_size)
+    for dic in rows:
+        writer.add(dic, table)
+    writer.flush()
+
+# Times the three insert paths on the same Hsp rows, each into an emptied
+# Hsp table of a database made by 'init -b'. The rows are built before the
+# clock starts, so only SQLite and the insert code are timed.
+def __inserts__(args):
+    workdir = tempfile.mkdtemp(prefix='blastxml2sql-bench-')
+    db = os.path.join(workdir, 'inserts.db')
+    open(db, 'w').close()
+    results = []
+    try:
+        __time_command__(['init', '-b', db])
+        con = sql.connect(db)
+        cur = con.cursor()
+        cur.execute("PRAGMA table_info(Hsp)")
+        columns = [(row[1], row[2]) for row in cur.fetchall() if row[1] != 'sid']
+        r = random.Random(1)
+        rows = []
+        for i in range(args.rows):
+            rows.append({name: i // 3 if 'parent' == name else
+                               r.randint(0, 500) if 'int' in kind else
+                               round(r.uniform(0, 500), 4) if 'float' in kind else
+                               ''.join(r.choice(AMINO_ACIDS) for j in range(8)) * 10
+                         for name, kind in columns})
+
+        common = {'run': strftime("%Y-%m-%dT%H:%M:%S"), 'commit': __commit__(),
+                  'label': args.label, 'reports': 0, 'queries': 0, 'hits': 0,
+                  'hsps': args.rows, 'peak_rss_mb': 'NA'}
+        paths = (('insert_string', lambda: __insert_string__(cur, 'Hsp', rows)),
+                 ('insert_param', lambda: __insert_param__(cur, 'Hsp', rows)),
+                 ('insert_bulk', lambda: __insert_bulk__(cur, 'Hsp', rows, args.batch_size)))
+        for stage, insert in paths:
+            cur.execute("DELETE FROM Hsp")
+            con.commit()
+            start = time()
+            insert()
+            con.commit()
+            seconds = time() - start
+            result = dict(common, stage=stage, seconds='{:.3f}'.format(seconds),
+                          rows=args.rows, rows_per_s='{:.0f}'.format(args.rows / seconds),
+                          db_mb='{:.1f}'.format(os.path.getsize(db) / 2 ** 20))
+            results.append(result)
+            print("{stage}\t{seconds}s\t{rows} rows\t{rows_per_s} rows/s".format(**result),
+                  file=sys.stderr)
+        con.close()
+    finally:
+        shutil.rmtree(workdir)
+    __write_results__(args.results, results)
+
+
+
+# Selects the lines of a run, given as run, commit or label. The most recent
+# matching run wins.
+def __select_run__(rows, runs, key):
+    for run in reversed(runs):
+        for row in rows:
+            if(row['run'] == run and key in (row['run'], row['commit'], row['label'])):
+                return(run)
+    print("No run matches '{}'".format(key))
+    sys.exit(1)
+
+def __compare__(args):
+    with open(args.results, newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    runs = []
+    for row in rows:
+        if(row['run'] not in runs):
+            runs.append(row['run'])
+    if(len(runs) < 2 and not (args.base and args.current)):
+        print("Comparing needs at least two runs in {}".format(args.results))
+        sys.exit(1)
+    base = __select_run__(rows, runs, args.base) if args.base else runs[-2]
+    current = __select_run__(rows, runs, args.current) if args.current else runs[-1]
+
+    a = {row['stage']: row for row in rows if row['run'] == base}
+    b = {row['stage']: row for row in rows if row['run'] == current}
+    for name, run in (('base', a), ('current', b)):
+        first = next(iter(run.values()))
+        print("# {}: {} {} {} ({} reports x {} queries x {} hits x {} hsps)".format(
+              name, first['run'], first['commit'], first['label'], first['reports'],
+              first['queries'], first['hits'], first['hsps']))
+    print('\t'.join(('stage', 'rows_per_s', 'rows_per_s', 'speedup',
+                     'peak_rss_mb', 'peak_rss_mb', 'db_mb', 'db_mb')))
+    for stage in a:
+        if(stage not in b):
+            continue
+        x, y = a[stage], b[stage]
+        speedup = 'NA'
+        if(float(x['rows_per_s']) > 0):
+            speedup = '{:.2f}'.format(float(y['rows_per_s']) / float(x['rows_per_s']))
+        print('\t'.join((stage, x['rows_per_s'], y['rows_per_s'], speedup,
+                         x['peak_rss_mb'], y['peak_rss_mb'], x['db_mb'], y['db_mb'])))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark blastxml2sql on synthetic BLAST reports")
+    parse(parser)
+    args = parser.parse_args()
+    args.func(args)
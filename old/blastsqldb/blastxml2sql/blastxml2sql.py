@@ -3,10 +3,13 @@
 import sys
 import argparse
 
+import sqltools.besthits   as besthits
 import sqltools.blastin    as blastin
 import sqltools.initialize as initialize
 import sqltools.metain     as metain
 import sqltools.retrieval  as retrieval
+import sqltools.stats      as stats
+import sqltools.taxonomy   as taxonomy
 
 # Top parser
 parser = argparse.ArgumentParser(
@@ -20,22 +23,38 @@ _input_parser.add_argument(
     help="Input file (from stdin)",
     default=sys.stdin)
 
+# Instrumentation parent parser, shared by all sub-commands
+_stats_parser = argparse.ArgumentParser(add_help=False)
+stats.parse(_stats_parser)
+
 sub = parser.add_subparsers(
-    help='sub-command help')
+    help='sub-command help',
+    dest='command')
 
 # sqltools.blast parser
 blast_parser = sub.add_parser(
     'blast', 
     help="Convert BLAST report XML to SQL db",
-    parents=[_input_parser],
+    parents=[_stats_parser],
     description="stub")
 blastin.parse(blast_parser)
 
+# sqltools.besthits parser
+besthits_parser = sub.add_parser(
+    'besthits',
+    help="Summarize the best hit of each query against each database",
+    parents=[_stats_parser],
+    description=("For each Iteration, sum the hsps of every hit and store "
+                 "the hit with the highest summed bit score in BestHits. "
+                 "Only iterations without a BestHits row are computed "
+                 "unless --all is given."))
+besthits.parse(besthits_parser)
+
 # sqltools.metadata parser
 meta_parser = sub.add_parser(
     'meta', 
-    help="Add meta data to SQL db (BUG: can take input only from pipe)",
-    parents=[_input_parser],
+    help="Add meta data to SQL db",
+    parents=[_input_parser, _stats_parser],
     description="Description stub")
 metain.parse(meta_parser)
 
@@ -43,13 +62,23 @@ metain.parse(meta_parser)
 init_parser = sub.add_parser(
     'init', 
     help="Initialize SQL database",
+    parents=[_stats_parser],
     description="Description stub")
 initialize.parse(init_parser)
 
+# sqltools.taxonomy parser
+tax_parser = sub.add_parser(
+    'taxonomy',
+    help="Manage the local NCBI taxonomy",
+    parents=[_stats_parser],
+    aliases=["tax"])
+taxonomy.parse(tax_parser)
+
 # sqltools.retrieve parser
 retr_parser = sub.add_parser(
     'retrieval',
     help="Retrieve data from database",
+    parents=[_stats_parser],
     aliases=["ret", "retr", "retrieve"])
 retrieval.parse(retr_parser)
 
@@ -63,4 +92,8 @@ parser.add_argument(
 args = parser.parse_args()
 
 # Pass arguments to proper sub-command
-args.func(args)
+stats.start(args)
+try:
+    args.func(args)
+finally:
+    stats.finish(args, args.command)
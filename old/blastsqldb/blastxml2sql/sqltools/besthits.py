@@ -0,0 +1,151 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# Summarizes the hsps of each hit and picks, for every query against every
+# database (i.e. every Iteration), the hit with the highest summed bit score.
+# The Hsp columns are pulled into NumPy arrays and all sums are computed as
+# segmented reductions, there is no Python-level loop over hits.
+#
+########################################################
+
+import argparse
+import sqlite3 as sql
+import sys
+import sqltools.misctools as misc
+import sqltools.stats as stats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def parse(parser):
+	parser.add_argument(
+		'-a', '--all',
+		help="recompute all best hits, not only those of new iterations",
+		default=False, action='store_true')
+	parser.add_argument(
+		'-b', '--batch_size',
+		help="number of Hsp rows fetched at a time (default=1000000)",
+		type=int, default=1000000)
+	parser.set_defaults(func=__besthits__)
+
+
+
+def check_numpy():
+    if(np is None):
+        print("Best hit calculation requires numpy")
+        sys.exit(1)
+
+
+
+# Summarizes the iterations that have no BestHits row yet, i.e. those added
+# since the last update. Only iterations with a sid above after are looked
+# at, so passing the largest sid before a load limits the update to the
+# iterations of that load.
+def update(cur, batch_size=1000000, after=0):
+    hsps = __fetch_hsps__(cur, batch_size, NEW_ITERATIONS, (after,))
+    with stats.current.timer('summarize'):
+        rows = __summarize__(hsps)
+    cur.executemany(misc.insert_cmd('BestHits', BESTHITS_COLUMNS, replace=True), rows)
+
+
+
+# Hsp columns that are summed over all hsps of a hit
+SUMMED = ('bit_score', 'score', 'identity', 'positive', 'gaps', 'align_len')
+
+# Iterations above a sid that have not been summarized yet
+NEW_ITERATIONS = ("WHERE Iteration.sid > ? " +
+                  "AND Iteration.sid NOT IN (SELECT iteration FROM BestHits)")
+
+# SQL selecting the hsp fields needed for summarizing. CROSS JOIN keeps
+# Iteration as the outer loop, so the hsps are found through the Hit_parent
+# and Hsp_parent_score indices and Hsp is never scanned, with or without
+# ANALYZE statistics.
+def hsp_cmd(where=""):
+    col = ('Iteration.sid', 'Hit.sid', 'evalue', 'query_from', 'query_to')
+    col += tuple('ifnull({}, 0)'.format(x) for x in SUMMED)
+    return("SELECT " + ', '.join(col) + " FROM Iteration " +
+           "CROSS JOIN Hit ON Hit.parent = Iteration.sid " +
+           "CROSS JOIN Hsp ON Hsp.parent = Hit.sid " + where)
+
+def __besthits__(args):
+    check_numpy()
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    with con:
+        cur = con.cursor()
+        if(args.all):
+            cur.execute("DELETE FROM BestHits")
+        update(cur, args.batch_size)
+
+
+
+# Loads the hsps as a dict of columns. Rows are fetched in batches and
+# converted straight to arrays, so the rows are never all held as tuples.
+def __fetch_hsps__(cur, batch_size, where="", param=()):
+    cur.execute(hsp_cmd(where), param)
+    ncol = 5 + len(SUMMED)
+    batches = []
+    while(True):
+        rows = cur.fetchmany(batch_size)
+        if(not rows): break
+        batches.append(np.array(rows, dtype=np.float64).reshape(len(rows), ncol))
+    if(batches):
+        dat = np.concatenate(batches)
+    else:
+        dat = np.empty((0, ncol))
+    names = ('iteration', 'hit', 'evalue', 'qfrom', 'qto') + SUMMED
+    return({name: dat[:, i] for i, name in enumerate(names)})
+
+
+
+BESTHITS_COLUMNS = ('iteration', 'hit', 'nhsp', 'evalue', 'merged_len') + SUMMED
+
+# Returns one row per Iteration, ordered as BESTHITS_COLUMNS
+def __summarize__(hsps):
+    if(len(hsps['hit']) == 0):
+        return([])
+
+    # Sort by hit and then by query start, so each hit is one contiguous
+    # segment with its hsps in query order
+    qstart = np.minimum(hsps['qfrom'], hsps['qto'])
+    qend = np.maximum(hsps['qfrom'], hsps['qto'])
+    order = np.lexsort((qstart, hsps['hit']))
+    hit = hsps['hit'][order]
+    qstart = qstart[order]
+    qend = qend[order]
+    first = np.flatnonzero(np.r_[True, hit[1:] != hit[:-1]])
+    segment = np.cumsum(np.r_[True, hit[1:] != hit[:-1]]) - 1
+
+    # Sums of all hsps of each hit
+    hits = {name: np.add.reduceat(hsps[name][order], first) for name in SUMMED}
+    hits['evalue'] = np.minimum.reduceat(hsps['evalue'][order], first)
+    hits['nhsp'] = np.diff(np.r_[first, len(hit)])
+    hits['hit'] = hit[first]
+    hits['iteration'] = hsps['iteration'][order][first]
+
+    # Number of query positions covered by at least one hsp. Offsetting each
+    # segment beyond the largest coordinate makes a single running maximum
+    # restart at every segment, giving the furthest end seen so far per hit.
+    offset = segment * (qend.max() + 1)
+    reach = np.maximum.accumulate(qend + offset) - offset
+    reach = np.r_[0, reach[:-1]]
+    reach[first] = 0
+    covered = np.maximum(0, qend - np.maximum(reach, qstart - 1))
+    hits['merged_len'] = np.add.reduceat(covered, first)
+
+    # The best hit of each iteration has the highest summed bit score, ties
+    # go to the earlier hit
+    order = np.lexsort((hits['hit'], -hits['bit_score'], hits['iteration']))
+    iteration = hits['iteration'][order]
+    best = order[np.r_[True, iteration[1:] != iteration[:-1]]]
+
+    columns = []
+    for name in BESTHITS_COLUMNS:
+        values = hits[name][best]
+        if(name not in ('evalue', 'bit_score', 'score')):
+            values = values.astype(np.int64)
+        columns.append(values.tolist())
+    return(list(zip(*columns)))
@@ -1,10 +1,16 @@
 #! /usr/bin/python3
 
 import argparse
+import glob
+import multiprocessing
+from collections import OrderedDict
 import sqlite3 as sql
 import xml.etree.ElementTree as et
-from time import gmtime, strftime
+from time import gmtime, strftime, time
+import sqltools.besthits as besthits
+import sqltools.initialize as initialize
 import sqltools.misctools as misc
+import sqltools.stats as stats
 import sys
 import os
 import re
@@ -13,6 +19,30 @@ import re
 ######## PUBLIC FUNCTION ###################################
 
 def parse(parser):
+	parser.add_argument(
+		'-i', '--input',
+		help=("BLAST report, directory of reports or glob pattern; "
+		      "may be given multiple times (default: stdin)"),
+		action='append')
+	parser.add_argument(
+		'-f', '--format',
+		help=("report format, XML (outfmt 5) or tabular (outfmt 6 or 7) "
+		      "(default=xml)"),
+		choices=('xml', 'tab'), default='xml')
+	parser.add_argument(
+		'--columns',
+		help=("space or comma separated fields of tabular reports, as given "
+		      "to -outfmt; ignored if the report has a '# Fields:' line "
+		      "(default='{}')".format(' '.join(TAB_COLUMNS))),
+		default=' '.join(TAB_COLUMNS))
+	parser.add_argument(
+		'--database',
+		help=("BLAST database of tabular reports without a '# Database:' "
+		      "line"))
+	parser.add_argument(
+		'-p', '--processes',
+		help="number of processes parsing reports in parallel (default=1)",
+		type=int, default=1)
 	parser.add_argument(
 		'-c', '--collection', 
 		help="parent blast collection")
@@ -22,46 +52,482 @@ def parse(parser):
 	parser.add_argument(
 		'-m', '--db_desc', 
 		help="BLAST database description")
+	parser.add_argument(
+		'-b', '--batch_size',
+		help="number of rows buffered per bulk insert (default=10000)",
+		type=int, default=10000)
+	parser.add_argument(
+		'-S', '--subject_cache',
+		help="number of subjects cached while loading (default=100000)",
+		type=int, default=100000)
+	parser.add_argument(
+		'-k', '--checkpoint',
+		help=("commit and record a checkpoint every this many iterations, "
+		      "0 to load everything in one transaction (default=1000)"),
+		type=int, default=1000)
+	parser.add_argument(
+		'-z', '--compress_alignments',
+		help=("store the qseq, hseq and midline strings zlib compressed "
+		      "in the HspAlignment table instead of in Hsp"),
+		default=False, action='store_true')
+	parser.add_argument(
+		'-B', '--besthits',
+		help="update BestHits for the newly loaded iterations",
+		default=False, action='store_true')
+	parser.add_argument(
+		'-F', '--fast_load',
+		help=("defer indices and relax journaling and syncing while "
+		      "loading (unsafe if interrupted)"),
+		default=False, action='store_true')
+	parser.add_argument(
+		'--cache_size',
+		help="page cache size in MiB when fast loading (default=256)",
+		type=int, default=256)
+	parser.add_argument(
+		'--mmap_size',
+		help="memory map size in MiB when fast loading (default=1024)",
+		type=int, default=1024)
 	parser.set_defaults(func=__blastin__)
 
 
 
+BLAST_TABLES = ('BlastOutput', 'Iteration', 'Subject', 'Hit', 'Hsp')
+
+# Types of the numeric columns, from the table definitions. Parsed text is
+# converted to these before it is sent to the writer. Parsed hits still hold
+# their subject fields, the writer moves them to Subject.
+TYPES = {table: initialize.column_types(table) for table in BLAST_TABLES}
+TYPES['Hit'].update(TYPES['Subject'])
+
+# Hit fields stored in Subject
+SUBJECT = ('accession', 'id', 'def', 'len')
+
+# Hsp fields moved to HspAlignment when compressing alignments
+ALIGNMENT = ('qseq', 'hseq', 'midline')
+
+# Number of parsed iterations a worker sends to the writer in one message
+CHUNK_SIZE = 100
+
+# Default fields of tabular reports (-outfmt 6 or 7 without a field list)
+TAB_COLUMNS = ('qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
+               'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore')
+
+# Fields identifying the query and the subject of a row, in order of
+# preference
+TAB_QUERY = ('qseqid', 'qaccver', 'qacc')
+TAB_SUBJECT = ('sseqid', 'saccver', 'sacc')
+
+# Tabular fields stored in Hsp
+TAB_HSP = {'bitscore': 'bit_score', 'score': 'score', 'evalue': 'evalue',
+           'qstart': 'query_from', 'qend': 'query_to', 'sstart': 'hit_from',
+           'send': 'hit_to', 'qframe': 'query_frame', 'sframe': 'hit_frame',
+           'nident': 'identity', 'positive': 'positive', 'length': 'align_len',
+           'gaps': 'gaps'}
+
+# Field names of the '# Fields:' line of outfmt 7
+TAB_NAMES = {'query id': 'qseqid', 'query acc.': 'qacc', 'query acc.ver': 'qaccver',
+             'query gi': 'qgi', 'query length': 'qlen',
+             'subject id': 'sseqid', 'subject ids': 'sallseqid', 'subject acc.': 'sacc',
+             'subject acc.ver': 'saccver', 'subject gi': 'sgi', 'subject length': 'slen',
+             'subject title': 'stitle', 'subject titles': 'salltitles',
+             '% identity': 'pident', 'alignment length': 'length',
+             'mismatches': 'mismatch', 'gap opens': 'gapopen', 'gaps': 'gaps',
+             'q. start': 'qstart', 'q. end': 'qend', 's. start': 'sstart', 's. end': 'send',
+             'evalue': 'evalue', 'bit score': 'bitscore', 'score': 'score',
+             'identical': 'nident', 'positives': 'positive', '% positives': 'ppos',
+             'query frame': 'qframe', 'sbjct frame': 'sframe',
+             'query seq': 'qseq', 'subject seq': 'sseq'}
+
+# Bytes of a tabular report read at a time
+TAB_BLOCK = 1 << 20
+
 def __blastin__(args):
-    tree = et.parse(args.input)
+    if(args.besthits):
+        besthits.check_numpy()
     filename = misc.set_db_path(args.sqldb)
-    con = sql.connect(filename)
-    with con:
-        cursor = con.cursor()
-        __parse_blast_xml__(tree.getroot(), cursor, args)
+    con = misc.connect(filename)
+    cursor = con.cursor()
+    if(args.fast_load):
+        pragmas = misc.fast_load_pragmas(args.cache_size, args.mmap_size)
+        pragmas = misc.set_pragmas(cursor, pragmas)
+        indices = misc.drop_indices(cursor, BLAST_TABLES)
+    else:
+        misc.restore_indices(cursor, BLAST_TABLES)
+    try:
+        with con:
+            __initialize_collection__(cursor, args)
+            writer = misc.BulkInsert(cursor, args.batch_size)
+            writer.subjects = SubjectCache(writer, args.subject_cache)
+            reports = __find_reports__(args.input, args.format)
+            streams = __open_streams__(reports, cursor)
+            loaded_after = __loaded_after__(cursor, streams)
+            if(args.processes > 1 and len(reports) > 1):
+                __load_parallel__(streams, writer, args)
+            else:
+                __load_serial__(streams, writer, args)
+            __commit_checkpoint__(writer, streams)
+    finally:
+        if(args.fast_load):
+            misc.create_indices(cursor, indices)
+            cursor.execute("ANALYZE")
+            misc.set_pragmas(cursor, pragmas)
+    # After the indices are rebuilt, which the update relies on
+    if(args.besthits):
+        with con:
+            besthits.update(cursor, after=loaded_after)
+    con.close()
 
 
 
-def __clean_tag__(tag):
-    tag = re.sub('^.*_', '', tag)
-    tag = re.sub('-', '_', tag)
-    return(tag)
+# Expands directories and glob patterns into a list of report files. In
+# directories, XML reports are the '*.xml' files and tabular reports are all
+# files.
+def __find_reports__(inputs, format='xml'):
+    if(not inputs):
+        return([sys.stdin])
+    reports = []
+    for path in inputs:
+        if(os.path.isdir(path)):
+            pattern = '*.xml' if format == 'xml' else '*'
+            reports += sorted(f for f in glob.glob(os.path.join(path, pattern))
+                              if os.path.isfile(f))
+        elif(glob.has_magic(path)):
+            reports += sorted(glob.glob(path))
+        else:
+            reports.append(path)
+    if(not reports):
+        print("No BLAST reports found in {}".format(', '.join(inputs)))
+        sys.exit(1)
+    return(reports)
 
 
 
-def __last_insert_rowid__(cur):
-    cur.execute("select last_insert_rowid()")
-    return(cur.fetchall())
+# Creates the bookkeeping of each report. Reports with a checkpoint from an
+# earlier, interrupted run resume after the last committed iteration; reports
+# that were loaded completely are skipped. Reports read from stdin cannot be
+# identified across runs and are not checkpointed.
+def __open_streams__(reports, cur):
+    streams = []
+    for report in reports:
+        stream = {'report': report, 'key': None, 'sid': None,
+                  'iter_num': 0, 'complete': 0, 'rows': 0}
+        if(isinstance(report, str)):
+            stream['key'] = os.path.abspath(report)
+            cur.execute("SELECT blastoutput, iter_num, complete " +
+                        "FROM BlastCheckpoint WHERE report = ?",
+                        (stream['key'],))
+            checkpoint = cur.fetchone()
+            if(checkpoint):
+                stream['sid'], stream['iter_num'], stream['complete'] = checkpoint
+        if(stream['complete']):
+            print("Skipping {}, already loaded".format(report), file=sys.stderr)
+            continue
+        streams.append(stream)
+    return(streams)
+
+
+
+# The largest Iteration sid before this load, the writer gives the iterations
+# of this load larger ones. Iterations committed by an interrupted run of a
+# resumed report count as part of this load.
+def __loaded_after__(cur, streams):
+    cur.execute("SELECT ifnull(max(sid), 0) FROM Iteration")
+    after = cur.fetchone()[0]
+    for stream in streams:
+        if(stream['sid'] is None): continue
+        cur.execute("SELECT min(sid) - 1 FROM Iteration WHERE parent = ?", (stream['sid'],))
+        first = cur.fetchone()[0]
+        if(first is not None):
+            after = min(after, first)
+    return(after)
+
+
+
+# The last loaded iteration of a report, None if the report is new
+def __resume__(stream):
+    if(stream['sid'] is None): return(None)
+    return(stream['iter_num'])
+
+
+
+# Writes all buffered rows along with the position reached in each report and
+# commits them together, so a later failure only loses uncommitted iterations
+def __commit_checkpoint__(writer, streams):
+    writer.flush()
+    for stream in streams:
+        if(stream['key'] is None or stream['sid'] is None): continue
+        writer.cur.execute(
+            "INSERT OR REPLACE INTO BlastCheckpoint " +
+            "(report, blastoutput, iter_num, complete) VALUES(?,?,?,?)",
+            (stream['key'], stream['sid'], stream['iter_num'], stream['complete']))
+    writer.cur.connection.commit()
+
+
+
+def __report_progress__(stream, seconds, nstreams):
+    if(nstreams < 2): return
+    print("{}\t{:.2f}s\t{} rows".format(stream['report'], seconds, stream['rows']),
+          file=sys.stderr)
+
+
+
+def __chunks__(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if(len(chunk) >= size):
+            yield(chunk)
+            chunk = []
+    yield(chunk)
+
+
+
+def __load_serial__(streams, writer, args):
+    # Without a way to resume, partial commits would only leave half a report
+    stdin = any(s['key'] is None for s in streams)
+    total = __input_size__(streams)
+    done = 0
+    uncommitted = 0
+    iterations = 0
+    for stream in streams:
+        start = time()
+        f = __open_report__(stream['report'], args)
+        records = __parse_report__(f, args, __resume__(stream))
+        try:
+            while(True):
+                with stats.current.timer('parse'):
+                    record = next(records, None)
+                if(record is None):
+                    break
+                with stats.current.timer('write'):
+                    n = __write_records__((record,), writer, stream)
+                uncommitted += n
+                iterations += n
+                if(args.checkpoint and not stdin and uncommitted >= args.checkpoint):
+                    __commit_checkpoint__(writer, streams)
+                    uncommitted = 0
+                if(stats.current.due()):
+                    offset = __offset__(f)
+                    stats.current.progress('blast', iterations,
+                                           None if offset is None else done + offset, total)
+        except (ValueError, et.ParseError) as e:
+            print("Failed to parse {}: {}".format(stream['report'], e))
+            sys.exit(1)
+        finally:
+            if(f is not stream['report']):
+                f.close()
+        stream['complete'] = 1
+        if(isinstance(stream['report'], str)):
+            done += os.path.getsize(stream['report'])
+            stats.current.bytes_read = done
+        __report_progress__(stream, time() - start, len(streams))
+
+
+
+# Reports are parsed in worker processes and the parsed records are sent back
+# through a bounded queue, all writing is done by this process. This avoids
+# SQLite lock contention and keeps memory bounded when the writer falls behind.
+def __load_parallel__(streams, writer, args):
+    queue = multiprocessing.Queue(maxsize=4 * args.processes)
+    pool = multiprocessing.Pool(args.processes, __init_worker__, (queue,))
+    for i, stream in enumerate(streams):
+        pool.apply_async(__parse_worker__, (i, stream['report'], args,
+                                            __resume__(stream)))
+        stream['start'] = time()
+    pool.close()
+    total = __input_size__(streams)
+    remaining = len(streams)
+    uncommitted = 0
+    iterations = 0
+    while(remaining):
+        with stats.current.timer('wait'):
+            i, kind, payload = queue.get()
+        stream = streams[i]
+        if('error' == kind):
+            pool.terminate()
+            print("Failed to parse {}: {}".format(stream['report'], payload))
+            sys.exit(1)
+        if('done' == kind):
+            remaining -= 1
+            stream['complete'] = 1
+            stream['offset'] = os.path.getsize(stream['report'])
+            stats.current.bytes_read = sum(s.get('offset', 0) for s in streams)
+            __report_progress__(stream, time() - stream['start'], len(streams))
+            continue
+        records, stream['offset'] = payload
+        with stats.current.timer('write'):
+            n = __write_records__(records, writer, stream)
+        uncommitted += n
+        iterations += n
+        if(args.checkpoint and uncommitted >= args.checkpoint):
+            __commit_checkpoint__(writer, streams)
+            uncommitted = 0
+        if(stats.current.due()):
+            stats.current.progress('blast', iterations,
+                                   sum(s.get('offset', 0) for s in streams), total)
+    pool.join()
+
+
+
+def __init_worker__(queue):
+    global __queue__
+    __queue__ = queue
+
+
+
+def __parse_worker__(i, report, args, resume):
+    try:
+        with __open_report__(report, args) as f:
+            for chunk in __chunks__(__parse_report__(f, args, resume), CHUNK_SIZE):
+                __queue__.put((i, 'records', (chunk, __offset__(f))))
+        __queue__.put((i, 'done', None))
+    except Exception as e:
+        __queue__.put((i, 'error', str(e)))
+
+
+
+# Interns subjects, so that each subject is stored once in Subject and hits
+# refer to it by key. A subject is identified by all its fields, not by its
+# accession alone, which e.g. BLAST databases made without -parse_seqids
+# reuse across databases. Recently used subjects are kept in an LRU cache
+# and looked up in the Subject table once evicted. Subjects added since the
+# last flush of the writer are not in the table yet and are found in
+# pending instead.
+class SubjectCache:
+    def __init__(self, writer, size=100000):
+        self.writer = writer
+        self.size = max(1, size)
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.flushes = writer.flushes
+        # While nothing was evicted from a cache that started on an empty
+        # table, a miss is a new subject and needs no lookup
+        writer.cur.execute("SELECT count(*) FROM (SELECT 1 FROM Subject LIMIT 1)")
+        self.complete = writer.cur.fetchone()[0] == 0
+
+    # Removes the subject fields from a parsed hit, returns the subject key
+    def key(self, hit):
+        subject = {field: hit.pop(field) for field in SUBJECT if field in hit}
+        fields = tuple(subject.get(field) for field in SUBJECT)
+        sid = self.cache.get(fields)
+        if(sid is not None):
+            self.cache.move_to_end(fields)
+            return(sid)
+
+        if(self.writer.flushes != self.flushes):
+            self.pending.clear()
+            self.flushes = self.writer.flushes
+        sid = self.pending.get(fields)
+        if(sid is None and not self.complete):
+            self.writer.cur.execute("SELECT sid FROM Subject WHERE accession = ? AND id = ? " +
+                                    "AND def = ? AND len IS ?", fields)
+            row = self.writer.cur.fetchone()
+            sid = row[0] if row else None
+        if(sid is None):
+            sid = self.writer.next_key('Subject')
+            subject['sid'] = sid
+            self.writer.add(subject, 'Subject')
+            # The add may have flushed, which clears pending on the next miss
+            if(self.writer.flushes == self.flushes):
+                self.pending[fields] = sid
+
+        self.cache[fields] = sid
+        if(len(self.cache) > self.size):
+            self.cache.popitem(last=False)
+            self.complete = False
+        return(sid)
+
+
+
+# Reports are opened here rather than by the parsers, so that the position
+# in the file can be read for progress reports
+def __open_report__(report, args):
+    if(not isinstance(report, str)):
+        return(report)
+    return(open(report, 'rb' if 'xml' == args.format else 'r'))
+
+# Bytes of the report read so far, None for pipes
+def __offset__(f):
+    try:
+        return(os.lseek(f.fileno(), 0, os.SEEK_CUR))
+    except (OSError, ValueError):
+        return(None)
+
+# Total size of the reports, None if one is read from stdin
+def __input_size__(streams):
+    if(not all(isinstance(s['report'], str) for s in streams)):
+        return(None)
+    return(sum(os.path.getsize(s['report']) for s in streams))
+
+
+
+# Writes parsed records, assigning the keys that link children to parents.
+# The stream dict holds the BlastOutput key, the last written iteration and
+# the row count of one report. Returns the number of iterations written.
+def __write_records__(records, writer, stream):
+    niterations = 0
+    for table, dat in records:
+        if('BlastOutput' == table):
+            stream['sid'] = misc.insert(dat, table, writer.cur)
+            stream['rows'] += 1
+            continue
+        iteration, hits = dat
+        iteration['parent'] = stream['sid']
+        iteration['sid'] = writer.next_key('Iteration')
+        writer.add(iteration, 'Iteration')
+        stream['iter_num'] = int(iteration['iter_num'])
+        stream['rows'] += 1
+        niterations += 1
+        for hit, hsps in hits:
+            hit['parent'] = iteration['sid']
+            hit['sid'] = writer.next_key('Hit')
+            hit['subject'] = writer.subjects.key(hit)
+            writer.add(hit, 'Hit')
+            for hsp, alignment in hsps:
+                hsp['parent'] = hit['sid']
+                hsp['sid'] = writer.next_key('Hsp')
+                writer.add(hsp, 'Hsp')
+                if(alignment):
+                    alignment['hsp'] = hsp['sid']
+                    writer.add(alignment, 'HspAlignment')
+            stream['rows'] += 1 + len(hsps)
+    return(niterations)
+
+
+
+# Column names of XML tags, cached since the same few tags repeat
+__tags__ = {}
+
+def __clean_tag__(tag):
+    if(tag not in __tags__):
+        __tags__[tag] = re.sub('-', '_', re.sub('^.*_', '', tag))
+    return(__tags__[tag])
+
+# Converts the numeric fields of a parsed row in place
+def __decode__(dat, table):
+    types = TYPES[table]
+    for key, value in dat.items():
+        if(key in types and value is not None):
+            try:
+                dat[key] = types[key](value)
+            except ValueError:
+                raise ValueError("Bad value '{}' for {}.{}".format(value, table, key))
+    return(dat)
 
 
 
 def __initialize_collection__(cur, args):
     if(not args.collection): return
-    sqlcmd = ("INSERT OR IGNORE INTO BlastCollection (name) " + 
-             "VALUES('" + args.collection + "');")
+    sqlcmd = "INSERT OR IGNORE INTO BlastCollection (name) VALUES(?);"
     try:
-        cur.execute(sqlcmd)
+        cur.execute(sqlcmd, (args.collection,))
     except Exception as e:
         print(e)
         sys.exit(1)
 
 
 
-def __parse_root__(root, table, cur, args):
+def __parse_root__(root, args):
     dat = {}
     dat['date_added'] = strftime("%y-%b-%d %H:%M:%S", gmtime())
     if(args.collection):  dat['parent']      = args.collection
@@ -76,13 +542,12 @@ def __parse_root__(root, table, cur, args):
                 dat[__clean_tag__(par.tag)] = par.text
             continue
         dat[__clean_tag__(child.tag)] = child.text
-    misc.insert(dat, table, cur) 
+    return(__decode__(dat, 'BlastOutput'))
 
 
  
-def __parse_iteration__(iteration, table, cur, args):
+def __parse_iteration__(iteration):
     dat = {}
-    dat['parent'] = __last_insert_rowid__(cur)[0][0]
     for child in iteration:
         if('Iteration_hits'    == child.tag): continue
         if('Iteration_message' == child.tag): continue
@@ -91,36 +556,222 @@ def __parse_iteration__(iteration, table, cur, args):
                 dat[__clean_tag__(stat.tag)] = stat.text
             continue
         dat[__clean_tag__(child.tag)] = child.text
-    misc.insert(dat, table, cur)
+    return(__decode__(dat, 'Iteration'))
 
 
 
-def __parse_hit__(hit, table, cur, args):
+def __parse_hit__(hit):
     dat = {}
-    dat['parent'] = __last_insert_rowid__(cur)[0][0]
     for child in hit:
         if("Hit_hsps" == child.tag): continue
         dat[__clean_tag__(child.tag)] = child.text
-    misc.insert(dat, table, cur)
+    return(__decode__(dat, 'Hit'))
 
 
 
-def __parse_hsp__(hsp, table, cur, args):
+def __parse_hsp__(hsp):
     dat = {}
-    dat['parent'] = __last_insert_rowid__(cur)[0][0]
     for child in hsp:
         dat[__clean_tag__(child.tag)] = child.text
-    misc.insert(dat, table, cur)
+    return(__decode__(dat, 'Hsp'))
+
+
+
+# Moves the alignment strings of an hsp into a separate, compressed record
+def __split_alignment__(hsp):
+    return({key: misc.deflate(hsp.pop(key) or '') for key in ALIGNMENT})
+
+
+
+def __parse_iteration_tree__(iteration, compress=False):
+    hits = []
+    for hit in iteration.findall("Iteration_hits/Hit"):
+        hsps = []
+        for hsp in hit.findall("Hit_hsps/Hsp"):
+            hsp = __parse_hsp__(hsp)
+            alignment = __split_alignment__(hsp) if compress else None
+            hsps.append((hsp, alignment))
+        hits.append((__parse_hit__(hit), hsps))
+    return((__parse_iteration__(iteration), hits))
+
+
+
+# Stream through the BLAST XML report structure, yielding (table, data)
+# records: first the BlastOutput row, then one record per Iteration holding
+# its hits and their hsps. Each Iteration is yielded as soon as its closing
+# tag is read and then released, so memory use is bounded by the largest
+# single Iteration rather than by the size of the report. When resuming, the
+# BlastOutput record and all iterations up to iter_num resume are skipped.
+def __parse_blast_xml__(source, args, resume=None):
+    context = et.iterparse(source, events=('start', 'end'))
+    event, root = next(context)
+    iterations = None
+    for event, elem in context:
+        if('start' == event):
+            # All header elements precede the iterations
+            if('BlastOutput_iterations' == elem.tag):
+                if(resume is None):
+                    yield(('BlastOutput', __parse_root__(root, args)))
+                iterations = elem
+            continue
+        if('Iteration' == elem.tag and iterations is not None):
+            if(resume is None or int(elem.findtext('Iteration_iter-num')) > resume):
+                yield(('Iteration', __parse_iteration_tree__(elem, args.compress_alignments)))
+            # Detach the finished Iteration so it can be garbage collected
+            iterations.clear()
 
 
 
-# Descend through BLAST XML report structure
-def __parse_blast_xml__(root, cur, args):
-    __initialize_collection__(cur, args)
-    __parse_root__(root, 'BlastOutput', cur, args)
-    for iteration in root.findall("./BlastOutput_iterations/Iteration"):
-        __parse_iteration__(iteration, 'Iteration', cur, args)
-        for hit in iteration.findall("Iteration_hits/Hit"):
-            __parse_hit__(hit, 'Hit', cur, args)
-            for hsp in hit.findall("Hit_hsps/Hsp"):
-                __parse_hsp__(hsp, 'Hsp', cur, args)
+def __parse_report__(source, args, resume=None):
+    if('tab' == args.format):
+        return(__parse_blast_tab__(source, args, resume))
+    return(__parse_blast_xml__(source, args, resume))
+
+
+
+# Maps the field list of an outfmt 7 '# Fields:' line to -outfmt names
+def __tab_fields__(line):
+    fields = []
+    for name in line.split(':', 1)[1].split(','):
+        name = name.strip()
+        fields.append(TAB_NAMES.get(name, name.replace(' ', '_')))
+    return(fields)
+
+# Column indices of the fields that are stored, so that rows can stay lists.
+# The query column may be missing from outfmt 7 reports, whose rows are then
+# taken to belong to the last '# Query:' line.
+def __tab_layout__(fields):
+    index = {field: i for i, field in enumerate(fields)}
+    query = [index[f] for f in TAB_QUERY if f in index]
+    subject = [index[f] for f in TAB_SUBJECT if f in index]
+    if(not subject):
+        raise ValueError("Tabular reports need one of the {} fields".format(
+                         ', '.join(TAB_SUBJECT)))
+    types = TYPES['Hsp']
+    layout = {'hsp': [(TAB_HSP[f], i, types[TAB_HSP[f]])
+                      for f, i in index.items() if f in TAB_HSP]}
+    for field in ('qlen', 'slen', 'pident', 'length'):
+        layout[field] = index.get(field)
+    layout['query'] = query[0] if query else None
+    layout['subject'] = subject[0]
+    layout['def'] = index.get('stitle', subject[0])
+    layout['accession'] = index.get('sacc', index.get('saccver', subject[0]))
+    layout['identity'] = 'nident' not in index and 'pident' in index and 'length' in index
+    return(layout)
+
+def __tab_hsp__(row, num, layout):
+    try:
+        hsp = {key: kind(row[i]) for key, i, kind in layout['hsp']}
+    except ValueError:
+        # Names the offending field
+        __decode__({key: row[i] for key, i, kind in layout['hsp']}, 'Hsp')
+    hsp['num'] = num
+    if(layout['identity']):
+        hsp['identity'] = round(float(row[layout['pident']]) * int(row[layout['length']]) / 100)
+    return(hsp)
+
+def __tab_hit__(row, num, layout):
+    hit = {'num': num, 'id': row[layout['subject']],
+           'def': row[layout['def']], 'accession': row[layout['accession']]}
+    if(layout['slen'] is not None):
+        hit['len'] = row[layout['slen']]
+    return(__decode__(hit, 'Hit'))
+
+# Groups the rows of one query into hits, the hsps of a hit being adjacent
+def __tab_iteration__(iter_num, query_def, rows, layout):
+    iteration = {'iter_num': iter_num}
+    if(rows and layout['query'] is not None):
+        iteration['query_ID'] = rows[0][layout['query']]
+    else:
+        iteration['query_ID'] = query_def.split()[0]
+    if(rows and layout['qlen'] is not None):
+        iteration['query_len'] = rows[0][layout['qlen']]
+    iteration['query_def'] = query_def or iteration['query_ID']
+    __decode__(iteration, 'Iteration')
+    hits = []
+    subject = None
+    column = layout['subject']
+    for row in rows:
+        if(row[column] != subject):
+            subject = row[column]
+            hsps = []
+            hits.append((__tab_hit__(row, len(hits) + 1, layout), hsps))
+        hsps.append((__tab_hsp__(row, len(hsps) + 1, layout), None))
+    return(('Iteration', (iteration, hits)))
+
+# Reads a tabular (outfmt 6 or 7) report into the same records as
+# __parse_blast_xml__, with null alignment strings and statistics. The file
+# is read in blocks of TAB_BLOCK bytes. Each query is one Iteration, numbered
+# in order of appearance; outfmt 7 also lists queries without hits.
+def __parse_blast_tab__(source, args, resume=None):
+    f = open(source) if isinstance(source, str) else source
+    layout = __tab_layout__(args.columns.replace(',', ' ').split())
+    layouts = {}
+    header = {'date_added': strftime("%y-%b-%d %H:%M:%S", gmtime())}
+    if(args.collection):  header['parent']      = args.collection
+    if(args.db_desc):     header['db_desc']     = args.db_desc
+    if(args.query_taxid): header['query_taxid'] = args.query_taxid
+    if(args.database):    header['db']          = args.database
+
+    iter_num = 0
+    started = False
+    def emit(query_def, rows):
+        nonlocal iter_num, started
+        if(not started):
+            started = True
+            if('db' not in header):
+                raise ValueError("No '# Database:' line in {}, ".format(source) +
+                                 "give the database with --database")
+            if(resume is None):
+                yield(('BlastOutput', __decode__(header, 'BlastOutput')))
+        iter_num += 1
+        if(resume is None or iter_num > resume):
+            yield(__tab_iteration__(iter_num, query_def, rows, layout))
+
+    # query is the id of the current rows, query_def the text of the last
+    # '# Query:' line; either opens a new Iteration
+    query, query_def, rows = None, '', []
+    try:
+        while(True):
+            lines = f.readlines(TAB_BLOCK)
+            if(not lines):
+                break
+            for line in lines:
+                if(line.startswith('#')):
+                    line = line[1:].strip()
+                    if(line.startswith('Query:')):
+                        if(query is not None or query_def):
+                            yield from emit(query_def, rows)
+                        query, query_def, rows = None, line[6:].strip(), []
+                    elif(line.startswith('Database:')):
+                        header.setdefault('db', line[9:].strip())
+                    elif(line.startswith('Fields:')):
+                        # Repeated for every query, so parsed once
+                        if(line not in layouts):
+                            layouts[line] = __tab_layout__(__tab_fields__(line))
+                        layout = layouts[line]
+                    elif(line.startswith(('BLAST', 'TBLAST'))):
+                        header.setdefault('program', line.split()[0].lower())
+                        header.setdefault('version', line)
+                    continue
+                values = line.rstrip('\r\n').split('\t')
+                if(len(values) < 2):
+                    continue
+                if(layout['query'] is not None):
+                    key = values[layout['query']]
+                elif(query_def):
+                    key = query_def
+                else:
+                    raise ValueError("No query field ({}) and no '# Query:' line in {}".format(
+                                     ', '.join(TAB_QUERY), source))
+                if(key != query):
+                    if(query is not None):
+                        yield from emit(query_def, rows)
+                        query_def = ''
+                    query, rows = key, []
+                rows.append(values)
+        if(query is not None or query_def):
+            yield from emit(query_def, rows)
+    finally:
+        if(f is not source):
+            f.close()
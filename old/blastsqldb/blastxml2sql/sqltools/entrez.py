@@ -0,0 +1,258 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# Asynchronous client for the NCBI E-utilities, for taxa that are missing
+# from the local taxonomy. Ids and names are sent in batches, requests share
+# a small pool of keep-alive connections, a token bucket keeps the request
+# rate under the NCBI limit and every raw response is cached on disk, keyed
+# by its request, so reruns do not touch the network.
+#
+########################################################
+
+import asyncio
+import hashlib
+import http.client
+import os
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+BASE = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+# Ids or names per request
+BATCH_SIZE = 200
+
+def parse(parser):
+    parser.add_argument(
+        '-e', '--entrez',
+        help="look up taxa missing from the local taxonomy on Entrez",
+        default=False, action='store_true')
+    parser.add_argument(
+        '--email',
+        help="email address sent to NCBI with each request")
+    parser.add_argument(
+        '--api_key',
+        help="NCBI API key, allows 10 rather than 3 requests per second")
+    parser.add_argument(
+        '--entrez_url',
+        help="E-utilities base URL, e.g. of a mirror (default={})".format(BASE),
+        default=BASE)
+    parser.add_argument(
+        '--cache',
+        help="directory for cached Entrez responses (default=~/.cache/blastxml2sql/entrez)",
+        default=os.path.join(os.path.expanduser('~'), '.cache', 'blastxml2sql', 'entrez'))
+
+# Builds a client from the options added by parse
+def client(args):
+    return(Client(base=args.entrez_url, email=args.email, api_key=args.api_key,
+                  cache=args.cache))
+
+
+
+# Returns a dict mapping each name that was found to its taxid, names
+# matching several taxa are left out
+def sciname2taxid(names, entrez):
+    return(asyncio.run(__sciname2taxid__(list(set(names)), entrez)))
+
+# Returns (lineages, names): a dict mapping each taxid that was found to its
+# lineage, from the root (1) down to the taxid, and a dict with the
+# scientific name of every taxid in these lineages. The lineage of a merged
+# taxid ends in the current taxid of its taxon instead.
+def taxid2lineage(taxids, entrez):
+    return(asyncio.run(__taxid2lineage__(list(set(taxids)), entrez)))
+
+
+
+# Allows rate requests per second on average, in bursts of at most capacity
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        if(self.lock is None):
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while(True):
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if(self.tokens >= 1):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Client:
+    def __init__(self, base=BASE, email=None, api_key=None, cache=None,
+                 rate=None, connections=3, retries=3):
+        url = urllib.parse.urlsplit(base)
+        self.https = url.scheme == 'https'
+        self.host = url.netloc
+        self.path = url.path if url.path.endswith('/') else url.path + '/'
+        self.params = {'tool': 'blastxml2sql'}
+        if(email):
+            self.params['email'] = email
+        if(api_key):
+            self.params['api_key'] = api_key
+        if(rate is None):
+            rate = 10 if api_key else 3
+        self.bucket = TokenBucket(rate)
+        self.cache = cache
+        self.connections = connections
+        self.retries = retries
+        self.pool = None
+        self.requests = 0
+
+    def __connect__(self):
+        if(self.https):
+            return(http.client.HTTPSConnection(self.host, timeout=60))
+        return(http.client.HTTPConnection(self.host, timeout=60))
+
+    # Blocking request on a pooled connection, run in an executor thread.
+    # A keep-alive connection closed by the server is reopened once.
+    def __fetch__(self, conn, url, body=None):
+        for attempt in range(2):
+            try:
+                if(body is None):
+                    conn.request('GET', url)
+                else:
+                    conn.request('POST', url, body,
+                                 {'Content-Type': 'application/x-www-form-urlencoded'})
+                response = conn.getresponse()
+                return(response.status, response.read())
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if(attempt):
+                    raise
+
+    def __cache_file__(self, url):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return(os.path.join(self.cache, key[:2], key))
+
+    async def get(self, tool, params):
+        return(await self.__request__(tool, params, False))
+
+    # POST sends the parameters in the request body, for long queries such as
+    # a batch of ORed names, which could exceed the URL length limit
+    async def post(self, tool, params):
+        return(await self.__request__(tool, params, True))
+
+    async def __request__(self, tool, params, post):
+        # The cache key leaves out the identification parameters
+        query = urllib.parse.urlencode(sorted(params.items()))
+        url = self.path + tool + '?' + query
+        if(self.cache):
+            cached = self.__cache_file__(url)
+            if(os.path.isfile(cached)):
+                with open(cached, 'rb') as f:
+                    return(f.read())
+
+        if(self.pool is None):
+            self.pool = asyncio.Queue()
+            for i in range(self.connections):
+                self.pool.put_nowait(self.__connect__())
+        if(post):
+            full, body = (self.path + tool + '?' + urllib.parse.urlencode(self.params),
+                          query.encode())
+        else:
+            full, body = (url + '&' + urllib.parse.urlencode(self.params), None)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            conn = await self.pool.get()
+            try:
+                status, response = await loop.run_in_executor(
+                    None, self.__fetch__, conn, full, body)
+            finally:
+                self.pool.put_nowait(conn)
+            self.requests += 1
+            # Too many requests or a server error, back off and retry
+            if(status == 429 or status >= 500):
+                await asyncio.sleep(2 ** attempt)
+                continue
+            break
+        if(status != 200):
+            raise IOError("Entrez returned HTTP {} for {}".format(status, url))
+
+        if(self.cache):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            with open(cached + '.tmp', 'wb') as f:
+                f.write(response)
+            os.replace(cached + '.tmp', cached)
+        return(response)
+
+    def close(self):
+        while(self.pool is not None and not self.pool.empty()):
+            self.pool.get_nowait().close()
+
+
+
+def __batches__(items):
+    return([items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)])
+
+# Parses an efetch TaxaSet into lineages and names. Merged taxids are listed
+# in AkaTaxIds and are mapped to the lineage of the taxon they merged into.
+def __parse_taxa__(body, lineages, names):
+    for taxon in ET.fromstring(body).findall('Taxon'):
+        taxid = int(taxon.findtext('TaxId'))
+        names[taxid] = taxon.findtext('ScientificName')
+        lineage = [1]
+        for parent in taxon.findall('LineageEx/Taxon'):
+            parent_id = int(parent.findtext('TaxId'))
+            names[parent_id] = parent.findtext('ScientificName')
+            if(parent_id != 1):
+                lineage.append(parent_id)
+        if(taxid != 1):
+            lineage.append(taxid)
+        lineages[taxid] = lineage
+        for aka in taxon.findall('AkaTaxIds/TaxId'):
+            lineages[int(aka.text)] = lineage
+
+async def __efetch__(entrez, taxids):
+    bodies = await asyncio.gather(*(
+        entrez.get('efetch.fcgi', {'db': 'taxonomy', 'id': ','.join(map(str, batch))})
+        for batch in __batches__(sorted(taxids))))
+    lineages = {}
+    names = {}
+    for body in bodies:
+        __parse_taxa__(body, lineages, names)
+    return(lineages, names)
+
+async def __taxid2lineage__(taxids, entrez):
+    try:
+        lineages, names = await __efetch__(entrez, taxids)
+    finally:
+        entrez.close()
+    return({t: lineages[t] for t in taxids if t in lineages}, names)
+
+# One esearch per batch of names finds their taxids, one efetch per batch of
+# taxids then gives the scientific names to map the taxids back to the names
+async def __sciname2taxid__(names, entrez):
+    try:
+        bodies = await asyncio.gather(*(
+            entrez.post('esearch.fcgi', {
+                'db': 'taxonomy',
+                'retmax': 10 * len(batch),
+                'term': ' OR '.join('"{}"[Scientific Name]'.format(n) for n in batch)})
+            for batch in __batches__(sorted(names))))
+        taxids = set()
+        for body in bodies:
+            taxids.update(int(i.text) for i in ET.fromstring(body).findall('IdList/Id'))
+        lineages, scinames = await __efetch__(entrez, taxids)
+    finally:
+        entrez.close()
+
+    found = {}
+    for taxid in taxids:
+        if(taxid in scinames):
+            found.setdefault(scinames[taxid].lower(), set()).add(taxid)
+    out = {}
+    for name in names:
+        matches = found.get(name.lower(), set())
+        if(len(matches) == 1):
+            out[name] = matches.pop()
+    return(out)
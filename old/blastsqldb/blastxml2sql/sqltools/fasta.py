@@ -0,0 +1,455 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# FASTA statistics in a single pass over a memory-mapped file, replacing the
+# fasta2info and fastatype scripts. The file is cut into chunks at line
+# boundaries and each chunk is counted with one NumPy bincount, giving the
+# composition of every record in the chunk at once. Records spanning chunks
+# are merged afterwards, so chunks can be counted in parallel.
+#
+# Sequences are fetched by name through an offset index kept next to the
+# FASTA file, in the samtools .fai layout, so no rescan is needed.
+#
+# Usage: fasta.py stats -t protein proteome.faa
+#        fasta.py type -v proteome.faa
+#        fasta.py index proteome.faa
+#        fasta.py fetch proteome.faa AT1G01010.1 AT1G01020.1
+#
+########################################################
+
+import argparse
+import mmap
+import multiprocessing as mp
+import os
+import string
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def parse(parser):
+    sub = parser.add_subparsers(
+        title="FASTA commands",
+        dest="fasta_function")
+
+    stats = sub.add_parser(
+        'stats',
+        help="Print the length, type and composition of each record")
+    stats.add_argument(
+        '-t', '--type',
+        help="alphabet to count",
+        choices=sorted(ALPHABETS), required=True)
+    stats.add_argument(
+        '-d', '--delimiter',
+        help="output delimiter (default=';')",
+        default=';')
+
+    seqtype = sub.add_parser(
+        'type',
+        help="Predict whether a FASTA file holds DNA, RNA or protein")
+    seqtype.add_argument(
+        '-v', '--verbose',
+        help="print counts of each sequence class",
+        default=False, action='store_true')
+
+    for p in (stats, seqtype):
+        p.add_argument(
+            'fasta',
+            help="FASTA file")
+        p.add_argument(
+            '-p', '--processes',
+            help="number of processes counting chunks (default=1)",
+            type=int, default=1)
+
+    index = sub.add_parser(
+        'index',
+        help="Build (or rebuild) the .fai offset index of a FASTA file")
+    index.add_argument(
+        'fasta',
+        help="FASTA file")
+
+    fetch = sub.add_parser(
+        'fetch',
+        help="Print the named sequences, building the index if needed")
+    fetch.add_argument(
+        'fasta',
+        help="FASTA file")
+    fetch.add_argument(
+        'names',
+        help="sequence names, i.e. the first word of the header",
+        nargs='*')
+    fetch.add_argument(
+        '-n', '--names_file',
+        help="file with one sequence name per line")
+
+    parser.set_defaults(func=__dispatch__)
+
+def __dispatch__(args):
+    check_numpy()
+    call = {'stats': __stats__,
+            'type': __type__,
+            'index': __index__,
+            'fetch': __fetch_and_print__}
+    call[args.fasta_function](args)
+
+
+
+def check_numpy():
+    if(np is None):
+        print("FASTA statistics require numpy")
+        sys.exit(1)
+
+# Yields (names, counts) batches covering every record in file order. counts
+# has one row per record and one column per entry of COLUMNS. Residues are
+# counted case-insensitively; whitespace is ignored.
+def records(filename, processes=1, chunk_size=None):
+    chunk_size = chunk_size or CHUNK_SIZE
+    with open(filename, 'rb') as f:
+        size = f.seek(0, 2)
+        if(size == 0):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = __chunks__(mm, chunk_size)
+    jobs = [(filename, start, end) for start, end in chunks]
+    if(processes > 1):
+        with mp.Pool(processes) as pool:
+            yield from __merge__(pool.imap(__count_chunk__, jobs))
+    else:
+        yield from __merge__(map(__count_chunk__, jobs))
+
+# Per record type guesses, as in fastatype. Sequences over 20 residues are
+# DNA, RNA or protein if made only of that alphabet and likely so if mostly
+# made of it; shorter ones are likely protein if they contain a residue
+# outside the nucleotide alphabets and are at least 5 long, otherwise short.
+def guess_types(counts):
+    length = seq_length(counts)
+    dna = counts[:, __columns__('ACGTN')].sum(axis=1)
+    rna = counts[:, __columns__('ACGUN')].sum(axis=1)
+    pro = counts[:, __columns__('ACDEFGHIKLMNPQRSTVWXY')].sum(axis=1)
+    share = np.maximum(length, 1)
+    long = length > 20
+    return(np.select(
+        [long & (dna == length), long & (dna / share > 0.9),
+         long & (rna == length), long & (rna / share > 0.9),
+         long & (pro == length), long & (pro / share > 0.95),
+         long,
+         (length > 4) & (dna < length) & (rna < length)],
+        ['DNA', 'likely DNA', 'RNA', 'likely RNA',
+         'protein', 'likely protein', 'uncertain', 'likely protein'],
+        'short'))
+
+# Number of residues, not counting gaps ('_') and stops ('*')
+def seq_length(counts):
+    return(counts[:, :26].sum(axis=1) + counts[:, COLUMNS.index('other')])
+
+# Random access to the sequences of an indexed FASTA file. The index is
+# built on first use, and rebuilt when the FASTA file is newer.
+class Fasta:
+    def __init__(self, filename):
+        self.index = load_index(filename)
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return(name in self.index)
+
+    def __getitem__(self, name):
+        return(__sequence__(self.mm, self.index[name]))
+
+    # Returns a dict of the sequences of all known names. They are read in
+    # file order, so a large batch is one sweep through the file.
+    def fetch(self, names):
+        entries = sorted((self.index[n][1], n) for n in set(names) if n in self.index)
+        return({n: __sequence__(self.mm, self.index[n]) for offset, n in entries})
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+def index_name(filename):
+    return(filename + '.fai')
+
+# Returns a dict mapping sequence names to (length, offset, line_bases,
+# line_bytes), reading the .fai file or building it first
+def load_index(filename):
+    fai = index_name(filename)
+    if(not os.path.isfile(fai) or os.path.getmtime(fai) < os.path.getmtime(filename)):
+        write_index(filename)
+    index = {}
+    with open(fai) as f:
+        for line in f:
+            name, length, offset, line_bases, line_bytes = line.rstrip('\n').split('\t')[:5]
+            index[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+    return(index)
+
+# Writes the .fai index of a FASTA file. Sequences must be wrapped at a fixed
+# width (the last line of each may be shorter), as for samtools faidx.
+def write_index(filename):
+    entries = build_index(filename)
+    with open(index_name(filename) + '.tmp', 'w') as f:
+        for entry in entries:
+            f.write('\t'.join(map(str, entry)) + '\n')
+    os.replace(index_name(filename) + '.tmp', index_name(filename))
+
+# Returns one (name, length, offset, line_bases, line_bytes) tuple per record
+def build_index(filename):
+    entries = []
+    seen = set()
+    with open(filename, 'rb') as f:
+        size = f.seek(0, 2)
+        if(size == 0):
+            return(entries)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if(mm[:1] == b'>'):
+                pos = 0
+            else:
+                pos = mm.find(b'\n>')
+                pos = size if pos < 0 else pos + 1
+            while(pos < size):
+                head_end = mm.find(b'\n', pos)
+                head_end = size if head_end < 0 else head_end
+                words = mm[pos + 1:head_end].split(None, 1)
+                name = words[0].decode() if words else ''
+                offset = min(head_end + 1, size)
+                following = mm.find(b'\n>', head_end)
+                end = size if following < 0 else following + 1
+                if(name in seen):
+                    print("Duplicate sequence name '{}', only the first is indexed".format(name),
+                          file=sys.stderr)
+                else:
+                    seen.add(name)
+                    entries.append((name,) + __layout__(mm, offset, end, name))
+                pos = end
+    return(entries)
+
+def __layout__(mm, offset, end, name):
+    raw = np.frombuffer(mm, dtype=np.uint8, count=end - offset, offset=offset)
+    try:
+        # Trailing line breaks and blank lines are not part of the layout
+        stop = len(raw)
+        while(stop > 0 and raw[stop - 1] in (10, 13)):
+            stop -= 1
+        newlines = np.flatnonzero(raw[:stop] == 10)
+        length = stop - len(newlines) - int((raw[:stop] == 13).sum())
+        if(length == 0):
+            return(0, offset, 0, 0)
+        if(len(newlines) == 0):
+            return(length, offset, length, length + 1)
+        line_bytes = int(newlines[0]) + 1
+        line_bases = line_bytes - 1 - int(newlines[0] > 0 and raw[newlines[0] - 1] == 13)
+        # Every line but the last must be full
+        lines = np.diff(np.r_[-1, newlines, stop - 1])
+        if(np.any(lines[:-1] != line_bytes) or lines[-1] > line_bases):
+            raise ValueError("Sequence '{}' has lines of different lengths, ".format(name) +
+                             "it cannot be indexed")
+        return(length, offset, line_bases, line_bytes)
+    finally:
+        del raw
+
+def __sequence__(mm, entry):
+    length, offset, line_bases, line_bytes = entry
+    if(length == 0):
+        return('')
+    span = length + (length - 1) // line_bases * (line_bytes - line_bases)
+    return(mm[offset:offset + span].translate(None, b'\r\n').decode())
+
+
+
+# Target number of bytes per chunk
+CHUNK_SIZE = 8 * 1024 * 1024
+
+ALPHABETS = {
+    'dna': 'ACGT',
+    'rna': 'ACGU',
+    'protein': 'ACDEFGHIKLMNPQRSTVWY'
+}
+
+# Count columns; letters are folded to upper case
+COLUMNS = tuple(string.ascii_uppercase) + ('gap', 'stop', 'other')
+
+def __columns__(letters):
+    return([COLUMNS.index(c) for c in letters])
+
+# Translation table mapping each byte to its count column. Whitespace and
+# header bytes get the two extra columns, which are dropped after counting.
+WHITESPACE = len(COLUMNS)
+HEADER = len(COLUMNS) + 1
+NCOL = len(COLUMNS) + 2
+
+def __lookup__():
+    table = [COLUMNS.index('other')] * 256
+    for i, c in enumerate(string.ascii_uppercase):
+        table[ord(c)] = i
+        table[ord(c.lower())] = i
+    table[ord('_')] = COLUMNS.index('gap')
+    table[ord('*')] = COLUMNS.index('stop')
+    for c in ' \t\r\n\v\f':
+        table[ord(c)] = WHITESPACE
+    return(bytes(table))
+
+LOOKUP = __lookup__()
+HEADER_BYTE = bytes([HEADER])
+
+# Splits the file into (start, end) byte ranges of about chunk_size bytes,
+# each ending after a newline
+def __chunks__(mm, chunk_size):
+    chunks = []
+    start = 0
+    while(start < len(mm)):
+        end = mm.find(b'\n', start + chunk_size)
+        end = len(mm) if end < 0 else end + 1
+        chunks.append((start, end))
+        start = end
+    return(chunks)
+
+# Counts one chunk. Returns (lead, names, counts), where lead tells whether
+# the first row continues a record started in an earlier chunk.
+def __count_chunk__(job):
+    filename, start, end = job
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return(__count__(mm, start, end))
+
+def __count__(mm, start, end):
+    # Each byte becomes its count column
+    cols = bytearray(mm[start:end].translate(LOOKUP))
+    n = len(cols)
+
+    raw = np.frombuffer(mm, dtype=np.uint8, count=n, offset=start)
+    line_starts = np.r_[0, np.flatnonzero(raw[:-1] == 10) + 1]
+    heads = line_starts[raw[line_starts] == ord('>')]
+    newlines = np.flatnonzero(raw == 10)
+    del raw
+    i = np.searchsorted(newlines, heads)
+    head_ends = np.where(i < len(newlines), newlines[np.minimum(i, len(newlines) - 1)], n)
+
+    names = []
+    for s, e in zip(heads.tolist(), head_ends.tolist()):
+        names.append(mm[start + s + 1:start + e].decode(errors='replace').rstrip('\r'))
+        cols[s:e] = HEADER_BYTE * (e - s)
+
+    # Record index of every byte, times NCOL, plus its column
+    lead = len(heads) == 0 or heads[0] > 0
+    bounds = np.r_[0, heads[heads > 0], n]
+    nrec = len(bounds) - 1
+    key = np.repeat(np.arange(nrec, dtype=np.intp) * NCOL, np.diff(bounds))
+    key += np.frombuffer(cols, dtype=np.uint8)
+    counts = np.bincount(key, minlength=nrec * NCOL).reshape(nrec, NCOL)
+    return(lead, names, counts[:, :len(COLUMNS)])
+
+# Joins records split across chunks. The last record of each chunk is held
+# back until the next chunk shows whether it continues.
+def __merge__(results):
+    name, pending = None, None
+    for lead, names, counts in results:
+        if(lead):
+            if(pending is not None):
+                pending = pending + counts[0]
+            counts = counts[1:]
+        if(len(names) == 0):
+            continue
+        if(pending is not None):
+            yield([name] + names[:-1], np.vstack((pending, counts[:-1])))
+        else:
+            yield(names[:-1], counts[:-1])
+        name, pending = names[-1], counts[-1]
+    if(pending is not None):
+        yield([name], pending.reshape(1, -1))
+
+
+
+def __stats__(args):
+    cols = __columns__(ALPHABETS[args.type])
+    out = sys.stdout
+    out.write(args.delimiter.join(['', 'length', 'type'] + sorted(ALPHABETS[args.type])) + '\n')
+    for names, counts in records(args.fasta, args.processes):
+        lengths = seq_length(counts).tolist()
+        types = guess_types(counts).tolist()
+        for row in zip(names, lengths, types, counts[:, cols].tolist()):
+            out.write(args.delimiter.join([row[0], str(row[1]), row[2]] +
+                                          [str(x) for x in row[3]]) + '\n')
+
+def __type__(args):
+    classes = ('short', 'DNA', 'likely DNA', 'RNA', 'likely RNA',
+               'protein', 'likely protein', 'uncertain')
+    total = dict.fromkeys(classes, 0)
+    nseq, gaps, stars, odd, nonletter = 0, 0, 0, 0, 0
+    for names, counts in records(args.fasta, args.processes):
+        types, n = np.unique(guess_types(counts), return_counts=True)
+        for t, k in zip(types.tolist(), n.tolist()):
+            total[t] += k
+        nseq += len(names)
+        gaps += int(counts[:, COLUMNS.index('gap')].sum())
+        stars += int(counts[:, COLUMNS.index('stop')].sum())
+        odd += int(counts[:, __columns__('BJOZ')].sum())
+        nonletter += int((counts[:, COLUMNS.index('other')] > 0).sum())
+
+    if(args.verbose):
+        for label, value in (('Sequences:', nseq),
+                             ('Short sequences (<20):', total['short']),
+                             ('Certain DNA seqs:', total['DNA']),
+                             ('Likely DNA seqs:', total['likely DNA']),
+                             ('Certain RNA seqs:', total['RNA']),
+                             ('Likely RNA seqs:', total['likely RNA']),
+                             ('Certain aa seqs:', total['protein']),
+                             ('Likely aa seqs:', total['likely protein']),
+                             ('Gaps:', gaps),
+                             ('Stars:', stars),
+                             ('Odd characters [BJOZ]:', odd),
+                             ('Non-letter containing seqs:', nonletter)):
+            print("{:<30}{}".format(label, value))
+        return
+
+    good = nseq - total['short']
+    if(total['DNA'] + total['likely DNA'] == good):
+        print("DNA")
+    elif(total['RNA'] + total['likely RNA'] == good):
+        print("RNA")
+    elif(total['protein'] + total['likely protein'] == good):
+        print("protein")
+    else:
+        print("uncertain")
+
+
+def __index__(args):
+    try:
+        write_index(args.fasta)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+def __fetch_and_print__(args):
+    names = list(args.names)
+    if(args.names_file):
+        with open(args.names_file) as f:
+            names += [line.strip() for line in f if line.strip()]
+    try:
+        fasta = Fasta(args.fasta)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    with fasta:
+        seqs = fasta.fetch(names)
+    for name in names:
+        if(name not in seqs):
+            print("No sequence named '{}'".format(name), file=sys.stderr)
+            continue
+        sys.stdout.write('>{}\n{}\n'.format(name, seqs[name]))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Single pass FASTA statistics")
+    parse(parser)
+    args = parser.parse_args()
+    args.func(args)
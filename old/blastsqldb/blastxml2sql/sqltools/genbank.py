@@ -0,0 +1,386 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# Streaming GenBank converter replacing gbk2csv, gbk2fasta and
+# prot_gbk2fasta. The input is read once in large blocks cut at '//' record
+# ends, blocks are parsed in a process pool and the feature table (CSV),
+# nucleotide FASTA and protein FASTA are written together, in input order.
+#
+# Usage: genbank.py -c features.tsv -n genes.fna -f gene -a proteins.faa *.gbff
+#
+########################################################
+
+import argparse
+import multiprocessing as mp
+import sys
+
+def parse(parser):
+    parser.add_argument(
+        'genbank',
+        help="GenBank files (default=stdin)",
+        nargs='*')
+    parser.add_argument(
+        '-c', '--csv',
+        help="write a table with one row per feature to this file ('-' for stdout)")
+    parser.add_argument(
+        '-n', '--nucleotide',
+        help="write nucleotide sequences to this FASTA file ('-' for stdout)")
+    parser.add_argument(
+        '-f', '--feature',
+        help="nucleotide sequences to write, the sequence of each record or "
+             "of each feature of this type (default=seq)",
+        choices=('seq', 'gene', 'mRNA', 'ncRNA', 'CDS'), default='seq')
+    parser.add_argument(
+        '-a', '--protein',
+        help=("write protein sequences to this FASTA file ('-' for stdout), "
+              "CDS translations or the sequence of GenPept records"))
+    parser.add_argument(
+        '--columns',
+        help="comma separated table columns (default=locus_tag), any of: " +
+             ', '.join(COLUMNS),
+        default='locus_tag')
+    parser.add_argument(
+        '-d', '--delimiter',
+        help="table delimiter (default=TAB)",
+        default='\t')
+    parser.add_argument(
+        '-H', '--no_header',
+        help="do not write the table header, e.g. to append to a table",
+        default=False, action='store_true')
+    parser.add_argument(
+        '-l', '--loci',
+        help="write only features whose locus_tag is listed in this file")
+    parser.add_argument(
+        '-p', '--processes',
+        help="number of parsing processes (default=1)",
+        type=int, default=1)
+    parser.set_defaults(func=__convert__)
+
+
+
+# Table columns, as in gbk2csv
+COLUMNS = ('locus_tag', 'gene', 'primary_tag', 'gi', 'GeneID', 'pseudo',
+           'taxon', 'organism', 'chromosome', 'mol_type', 'ecotype',
+           'protein_id', 'transcript_id', 'ncRNA_class', 'codon_start',
+           'gene_synonym', 'product', 'location', 'function', 'inference',
+           'exception', 'note', 'citation')
+
+# Bytes of input per block handed to a parsing process
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# FASTA line width
+WIDTH = 60
+
+# Parses the text of one record into a dict with the LOCUS, DEFINITION,
+# VERSION, feature table and ORIGIN sequence
+def parse_record(text):
+    rec = {'locus': 'NA', 'length': 'NA', 'aa': False, 'definition': '',
+           'version': 'NA', 'gi': 'NA', 'features': [], 'seq': ''}
+    lines = text.split('\n')
+    i = 0
+    while(i < len(lines)):
+        line = lines[i]
+        i += 1
+        if(line.startswith('LOCUS')):
+            words = line.split()
+            rec['locus'] = words[1] if len(words) > 1 else 'NA'
+            rec['length'] = words[2] if len(words) > 2 else 'NA'
+            rec['aa'] = len(words) > 3 and words[3] == 'aa'
+        elif(line.startswith('DEFINITION')):
+            definition = [line[12:].strip()]
+            while(i < len(lines) and lines[i].startswith(' ' * 12)):
+                definition.append(lines[i].strip())
+                i += 1
+            rec['definition'] = ' '.join(definition)
+        elif(line.startswith('VERSION')):
+            words = line.split()
+            rec['version'] = words[1] if len(words) > 1 else 'NA'
+            for word in words[2:]:
+                if(word.startswith('GI:')):
+                    rec['gi'] = word[3:]
+        elif(line.startswith('FEATURES')):
+            start = i
+            while(i < len(lines) and lines[i].startswith(' ')):
+                i += 1
+            rec['features'] = __parse_features__(lines[start:i])
+        elif(line.startswith('ORIGIN')):
+            rec['seq'] = ''.join(lines[i:]).translate(SEQ_DELETE).upper()
+            break
+    return(rec)
+
+SEQ_DELETE = str.maketrans('', '', '0123456789 \t\r/')
+
+# Features are (key, location, [(qualifier, value)]). Qualifier values
+# continued over several lines are joined with spaces, except translations.
+def __parse_features__(lines):
+    features = []
+    for line in lines:
+        if(len(line) > 5 and line[5] != ' '):
+            features.append((line[5:21].strip(), [line[21:].strip()], []))
+        elif(not features):
+            continue
+        elif(line[21:22] == '/'):
+            name, eq, value = line[22:].rstrip().partition('=')
+            features[-1][2].append([name, value if eq else None])
+        elif(features[-1][2]):
+            qualifier = features[-1][2][-1]
+            glue = '' if qualifier[0] == 'translation' else ' '
+            qualifier[1] = (qualifier[1] or '') + glue + line.strip()
+        else:
+            features[-1][1].append(line.strip())
+    return([(key, ''.join(location), [(n, __unquote__(v)) for n, v in quals])
+            for key, location, quals in features])
+
+def __unquote__(value):
+    if(value is not None and len(value) > 1 and value[0] == '"' and value[-1] == '"'):
+        return(value[1:-1].replace('""', '"'))
+    return(value)
+
+def __tag__(quals, tag):
+    for name, value in quals:
+        if(name == tag):
+            return('NA' if value is None else value)
+    return('NA')
+
+def __db_xref__(quals, db):
+    for name, value in quals:
+        if(name == 'db_xref' and value):
+            ref_db, colon, ref = value.partition(':')
+            if(ref_db == db and colon):
+                return(ref)
+    return('NA')
+
+# Sequence of a feature location, e.g. complement(join(<1..20,30..>45)).
+# Returns None for locations referring to other records.
+def extract(location, seq):
+    location = location.replace('<', '').replace('>', '')
+    if(location.startswith('complement(') and location.endswith(')')):
+        inner = extract(location[11:-1], seq)
+        return(None if inner is None else inner[::-1].translate(COMPLEMENT))
+    for op in ('join(', 'order('):
+        if(location.startswith(op) and location.endswith(')')):
+            parts = [extract(part, seq) for part in __split_top__(location[len(op):-1])]
+            return(None if None in parts else ''.join(parts))
+    if(':' in location):
+        return(None)
+    if('..' in location):
+        start, end = location.split('..', 1)
+        return(seq[int(start) - 1:int(end)])
+    if('^' in location):
+        return('')
+    return(seq[int(location) - 1:int(location)])
+
+COMPLEMENT = str.maketrans('ACGTUMRWSYKVHDBNacgtumrwsykvhdbn',
+                           'TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn')
+
+def __split_top__(text):
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(text):
+        if(c == '('):
+            depth += 1
+        elif(c == ')'):
+            depth -= 1
+        elif(c == ',' and depth == 0):
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return(parts)
+
+def __columnify__(seq):
+    return(''.join(seq[i:i + WIDTH] + '\n' for i in range(0, len(seq), WIDTH)))
+
+
+
+# Options of the current conversion, set in each parsing process
+__options__ = {}
+
+def __init_worker__(options):
+    __options__.update(options)
+
+# Converts a block of records, returns the text of each sink
+def __convert_block__(block):
+    opt = __options__
+    table, nucleotide, protein = [], [], []
+    # Each piece after the first starts with the rest of a '//' line
+    for text in block.decode(errors='replace').split('\n//'):
+        if(not text.strip()):
+            continue
+        rec = parse_record(text)
+        source = {}
+        for key, location, quals in rec['features']:
+            if(key == 'source'):
+                source = {'taxon': __db_xref__(quals, 'taxon')}
+                for tag in ('organism', 'chromosome', 'mol_type', 'ecotype'):
+                    source[tag] = __tag__(quals, tag)
+                if(opt['nucleotide'] and opt['feature'] == 'seq' and not rec['aa']):
+                    nucleotide.append('>' + rec['definition'] + '\n' +
+                                      __columnify__(rec['seq']))
+                continue
+            if(opt['loci'] is not None and __tag__(quals, 'locus_tag') not in opt['loci']):
+                continue
+            if(opt['csv'] and key not in ('gap', 'STS')):
+                table.append(__table_row__(key, location, quals, source, opt))
+            if(opt['nucleotide'] and key == opt['feature']):
+                seq = extract(location, rec['seq'])
+                if(seq is not None):
+                    nucleotide.append(__feature_header__(key, quals, source) + '\n' +
+                                      __columnify__(seq))
+            if(opt['protein'] and key == 'CDS' and not rec['aa'] and
+               __tag__(quals, 'translation') != 'NA'):
+                protein.append(__feature_header__('protein', quals, source) + '\n' +
+                               __columnify__(__tag__(quals, 'translation')))
+        # GenPept records hold the protein itself, headed as in prot_gbk2fasta
+        if(opt['protein'] and rec['aa']):
+            fields = (('locus', rec['locus']), ('gi', rec['gi']), ('gb', rec['version']),
+                      ('gene', __first__(rec, 'gene')), ('taxon', source.get('taxon', 'NA')))
+            protein.append('>' + '|'.join(k + '|' + v for k, v in fields) + '\n' +
+                           __columnify__(rec['seq']))
+    return(''.join(table), ''.join(nucleotide), ''.join(protein))
+
+def __first__(rec, tag):
+    for key, location, quals in rec['features']:
+        value = __tag__(quals, tag)
+        if(value != 'NA'):
+            return(value)
+    return('NA')
+
+def __table_row__(key, location, quals, source, opt):
+    row = dict(source)
+    row['primary_tag'] = key
+    row['gi'] = __db_xref__(quals, 'GI')
+    row['GeneID'] = __db_xref__(quals, 'GeneID')
+    row['location'] = location
+    row['pseudo'] = 'TRUE' if any(n == 'pseudo' for n, v in quals) else 'FALSE'
+    # Any other column is the first value of the qualifier of that name
+    tags = {}
+    for name, value in reversed(quals):
+        tags[name] = value
+    return(opt['delimiter'].join(row.get(c) or tags.get(c) or 'NA'
+                                 for c in opt['columns']) + '\n')
+
+# FASTA headers of gbk2fasta
+def __feature_header__(kind, quals, source):
+    header = ">locus|{}|taxon|{}|gene|{}|".format(
+        __tag__(quals, 'locus_tag'), source.get('taxon', 'NA'), __tag__(quals, 'gene'))
+    if(kind == 'gene'):
+        header += "gene|{}|GeneID|{}".format(__tag__(quals, 'gene'),
+                                             __db_xref__(quals, 'GeneID'))
+        if(any(n == 'pseudo' for n, v in quals)):
+            header += "|pseudo"
+    elif(kind in ('protein', 'CDS')):
+        header += "gi|{}|gb|{}".format(__db_xref__(quals, 'GI'), __tag__(quals, 'protein_id'))
+        if(kind == 'CDS'):
+            header += "|codon_start|{}".format(__tag__(quals, 'codon_start'))
+    elif(kind == 'mRNA'):
+        header += "transcript_id|{}".format(__tag__(quals, 'transcript_id'))
+    elif(kind == 'ncRNA'):
+        header += "ncRNA_class|{} {}".format(__tag__(quals, 'ncRNA_class'),
+                                             __tag__(quals, 'product'))
+    return(header)
+
+
+
+# Yields blocks of whole records, cut after a '//' line. Only the newly read
+# bytes (and the two before them) are searched for the end of a record and
+# the pieces of a record are joined once, so a record larger than a block
+# stays linear.
+def __blocks__(streams, block_size):
+    for stream in streams:
+        pieces = []
+        size = 0
+        tail = b''
+        mark = False
+        while(True):
+            data = stream.read(block_size)
+            if(not data):
+                break
+            window = tail + data
+            offset = size - len(tail)
+            tail = window[-2:]
+            pieces.append(data)
+            size += len(data)
+            end = window.rfind(b'\n//')
+            if(end >= 0):
+                # The '//' line may end in the next block
+                mark = True
+                eol = window.find(b'\n', end + 1)
+                cut = -1 if eol < 0 else offset + eol
+            elif(mark):
+                eol = data.find(b'\n')
+                cut = -1 if eol < 0 else size - len(data) + eol
+            else:
+                cut = -1
+            if(cut < 0):
+                continue
+            data = b''.join(pieces)
+            yield(data[:cut + 1])
+            rest = data[cut + 1:]
+            pieces = [rest] if rest else []
+            size = len(rest)
+            tail = rest[-2:]
+            mark = False
+        rest = b''.join(pieces)
+        if(rest.strip()):
+            yield(rest)
+
+def __open_sink__(name):
+    if(name == '-'):
+        return(sys.stdout)
+    return(open(name, 'w'))
+
+def __convert__(args):
+    columns = args.columns.split(',')
+    for column in columns:
+        if(column not in COLUMNS):
+            print("Unknown column '{}'".format(column))
+            sys.exit(1)
+    if(not (args.csv or args.nucleotide or args.protein)):
+        print("Nothing to write, give at least one of --csv, --nucleotide or --protein")
+        sys.exit(1)
+    loci = None
+    if(args.loci):
+        with open(args.loci) as f:
+            loci = {line.split()[0] for line in f if line.strip()}
+    options = {'csv': bool(args.csv), 'nucleotide': bool(args.nucleotide),
+               'protein': bool(args.protein), 'feature': args.feature,
+               'columns': columns, 'delimiter': args.delimiter, 'loci': loci}
+
+    try:
+        streams = [open(f, 'rb') for f in args.genbank] or [sys.stdin.buffer]
+        sinks = [__open_sink__(f) if f else None
+                 for f in (args.csv, args.nucleotide, args.protein)]
+    except OSError as e:
+        print(e)
+        sys.exit(1)
+    if(sinks[0] and not args.no_header):
+        sinks[0].write(args.delimiter.join(columns) + '\n')
+
+    blocks = __blocks__(streams, BLOCK_SIZE)
+    if(args.processes > 1):
+        pool = mp.Pool(args.processes, initializer=__init_worker__, initargs=(options,))
+        results = pool.imap(__convert_block__, blocks)
+    else:
+        pool = None
+        __init_worker__(options)
+        results = map(__convert_block__, blocks)
+    for texts in results:
+        for sink, text in zip(sinks, texts):
+            if(sink and text):
+                sink.write(text)
+    if(pool):
+        pool.close()
+        pool.join()
+
+    for f in streams + sinks:
+        if(f and f not in (sys.stdin.buffer, sys.stdout)):
+            f.close()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert GenBank files to a feature table and FASTA files")
+    parse(parser)
+    args = parser.parse_args()
+    args.func(args)
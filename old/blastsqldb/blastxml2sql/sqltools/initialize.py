@@ -8,6 +8,7 @@
 ########################################################
 
 import argparse
+import re
 import sqlite3 as sql
 import sqltools.misctools as misc
 import sys
@@ -33,7 +34,7 @@ def __initialize__(args):
         sys.exit(0)
 
     filename = misc.set_db_path(args.sqldb)
-    con = sql.connect(filename)
+    con = misc.connect(filename)
     with con:
         cur = con.cursor()
         cur.execute("pragma foreign_keys = ON")
@@ -43,107 +44,178 @@ def __initialize__(args):
 
 
 
-def __init_blast__(cur):
-    COLLECTION_VAL = ','.join((
-        "name varchar primary key",
-        "desc varchar",
-    ))
-
-    BLAST_VAL = ','.join((
-            # keys
-        "parent varchar",
-        "sid   integer primary key autoincrement",
-            # Added fields
-        "db_desc     varchar",
-        "query_taxid int check(query_taxid >= 0)",
-            # Automatic fields
-        "date_added varchar not null",
-            # Main tags
-        "program varchar not null",
-        "version varchar not null",
-        "db      varchar not null",
-            # Parameter tags
-        "matrix     varchar not null",
-        "expect     float   not null check(expect >= 0)",
-        "gap_open   tinyint not null check(gap_open >= 0)",
-        "gap_extend tinyint not null check(gap_extend >= 0)",
-        "filter     varchar not null",
-            # Constraints
-        """foreign key(parent) references BlastCollection(name) 
-            on delete set null 
-            on update cascade"""
-    ))
-
-    ITERATION_VAL = ','.join((
-            # keys
-        "parent int",
-        "sid    integer primary key autoincrement",
-            # Main tags
-        "iter_num  int     not null check(iter_num >= 0)",
-        "query_ID  varchar not null",
-        "query_def varchar not null",
-        "query_len int     not null check(query_len >= 0)",
-            # Statistic tags
-        "db_num    int   not null check(db_num >= 0)",
-        "db_len    int   not null check(db_len >= 0)",
-        "hsp_len   int   not null check(hsp_len >= 0)",
-        "eff_space float not null check(eff_space >= 0)",
-        "kappa     float not null check(kappa >= 0)",
-        "lambda    float not null check(lambda >= 0)",
-        "entropy   float not null check(entropy >= 0)",
-            # Constraints
-        """foreign key(parent) references BlastOutput(sid) 
-            on delete cascade
-            on update cascade"""
-    ))
-
-    HIT_VAL = ','.join((
-            # keys
-        "parent int",
-        "sid   integer primary key autoincrement",
-            # Main tags
-        "num       int     not null check(num >= 0)",
-        "id        varchar not null",
-        "def       varchar not null",
-        "accession varchar not null",
-        "len       int     not null check(num >= 0)",
-            # Constraints
-        """foreign key(parent) references Iteration(sid) 
-            on delete cascade
-            on update cascade"""
-    ))
-
-    HSP_VAL = ','.join((
-            # keys
-        "parent int",
-            # Main tags
-        "num         int   not null check(num >= 0)", 
-        "bit_score   float not null check(bit_score >= 0)",
-        "score       float not null check(score >= 0)",
-        "evalue      float not null check(evalue >= 0)",
-        "query_from  int   not null check(query_from >= 0)",
-        "query_to    int   not null check(query_to >= 0)",
-        "hit_from    int   not null check(hit_from >= 0)",
-        "hit_to      int   not null check(hit_to >= 0)",
-        "query_frame int   not null check(query_frame >= 0)",
-        "hit_frame   int   not null check(hit_frame >= 0)",
-        "identity    int   not null check(identity >= 0)",
-        "positive    int   not null check(positive >= 0)",
-        "align_len   int   not null check(align_len >= 0)",
-        "gaps        int            check(gaps >= 0)",
-        "qseq        varchar not null",
-        "hseq        varchar not null",
-        "midline     varchar not null",
-            # Constraints
-        """foreign key(parent) references Hit(sid) 
-            on delete cascade
-            on update cascade"""
-    ))
+COLLECTION_VAL = ','.join((
+    "name varchar primary key",
+    "desc varchar",
+))
+
+BLAST_VAL = ','.join((
+        # keys
+    "parent varchar",
+    "sid   integer primary key autoincrement",
+        # Added fields
+    "db_desc     varchar",
+    "query_taxid int check(query_taxid >= 0)",
+        # Automatic fields
+    "date_added varchar not null",
+        # Main tags
+    "program varchar",
+    "version varchar",
+    "db      varchar not null",
+        # Parameter tags, null for tabular reports
+    "matrix     varchar",
+    "expect     float   check(expect >= 0)",
+    "gap_open   tinyint check(gap_open >= 0)",
+    "gap_extend tinyint check(gap_extend >= 0)",
+    "filter     varchar",
+        # Constraints
+    """foreign key(parent) references BlastCollection(name) 
+        on delete set null 
+        on update cascade"""
+))
+
+ITERATION_VAL = ','.join((
+        # keys
+    "parent int",
+    "sid    integer primary key autoincrement",
+        # Main tags
+    "iter_num  int     not null check(iter_num >= 0)",
+    "query_ID  varchar not null",
+    "query_def varchar not null",
+    "query_len int             check(query_len >= 0)",
+        # Statistic tags, null for tabular reports
+    "db_num    int   check(db_num >= 0)",
+    "db_len    int   check(db_len >= 0)",
+    "hsp_len   int   check(hsp_len >= 0)",
+    "eff_space float check(eff_space >= 0)",
+    "kappa     float check(kappa >= 0)",
+    "lambda    float check(lambda >= 0)",
+    "entropy   float check(entropy >= 0)",
+        # Constraints
+    """foreign key(parent) references BlastOutput(sid) 
+        on delete cascade
+        on update cascade"""
+))
+
+# One row per subject sequence, shared by all its hits
+SUBJECT_VAL = ','.join((
+        # keys
+    "sid integer primary key",
+        # Main tags
+    "accession varchar not null",
+    "id        varchar not null",
+    "def       varchar not null",
+    "len       int     check(len >= 0)",
+        # Constraints, the accession alone does not identify a sequence:
+        # without -parse_seqids it is the BL_ORD_ID ordinal in its database
+    "unique(accession, id, def, len)"
+))
+
+HIT_VAL = ','.join((
+        # keys
+    "parent  int",
+    "sid     integer primary key autoincrement",
+    "subject int not null",
+        # Main tags
+    "num     int not null check(num >= 0)",
+        # Constraints
+    """foreign key(parent) references Iteration(sid) 
+        on delete cascade
+        on update cascade""",
+    """foreign key(subject) references Subject(sid)
+        on update cascade"""
+))
+
+HSP_VAL = ','.join((
+        # keys
+    "parent int",
+    "sid    integer primary key autoincrement",
+        # Main tags
+    "num         int   not null check(num >= 0)", 
+    "bit_score   float not null check(bit_score >= 0)",
+    "score       float          check(score >= 0)",
+    "evalue      float not null check(evalue >= 0)",
+    "query_from  int   not null check(query_from >= 0)",
+    "query_to    int   not null check(query_to >= 0)",
+    "hit_from    int   not null check(hit_from >= 0)",
+    "hit_to      int   not null check(hit_to >= 0)",
+    "query_frame int            check(query_frame >= 0)",
+    "hit_frame   int            check(hit_frame >= 0)",
+    "identity    int   not null check(identity >= 0)",
+    "positive    int            check(positive >= 0)",
+    "align_len   int   not null check(align_len >= 0)",
+    "gaps        int            check(gaps >= 0)",
+        # Null if the alignment is stored in HspAlignment
+    "qseq        varchar",
+    "hseq        varchar",
+    "midline     varchar",
+        # Constraints
+    """foreign key(parent) references Hit(sid) 
+        on delete cascade
+        on update cascade"""
+))
+
+# zlib compressed alignment strings, kept out of the Hsp table so that
+# scans over scores do not read them
+ALIGNMENT_VAL = ','.join((
+        # keys
+    "hsp integer primary key",
+        # Main tags
+    "qseq    blob not null",
+    "hseq    blob not null",
+    "midline blob not null",
+        # Constraints
+    """foreign key(hsp) references Hsp(sid)
+        on delete cascade
+        on update cascade"""
+))
 
+# Summed hsps of the best hit of each Iteration
+BESTHITS_VAL = ','.join((
+        # keys
+    "iteration integer primary key",
+    "hit       int not null",
+        # Summary of all hsps of the hit
+    "nhsp       int   not null check(nhsp >= 0)",
+    "evalue     float not null check(evalue >= 0)",
+    "merged_len int   not null check(merged_len >= 0)",
+    "bit_score  float not null check(bit_score >= 0)",
+    "score      float not null check(score >= 0)",
+    "identity   int   not null check(identity >= 0)",
+    "positive   int   not null check(positive >= 0)",
+    "gaps       int   not null check(gaps >= 0)",
+    "align_len  int   not null check(align_len >= 0)",
+        # Constraints
+    """foreign key(iteration) references Iteration(sid)
+        on delete cascade
+        on update cascade""",
+    """foreign key(hit) references Hit(sid)
+        on delete cascade
+        on update cascade"""
+))
+
+# Ingestion bookkeeping, one row per report file
+CHECKPOINT_VAL = ','.join((
+    "report      varchar primary key",
+    "blastoutput int",
+    "iter_num    int     not null check(iter_num >= 0)",
+    "complete    tinyint not null default 0",
+        # Constraints
+    """foreign key(blastoutput) references BlastOutput(sid)
+        on delete cascade
+        on update cascade"""
+))
+
+def __init_blast__(cur):
     # The drop commands must be performed in this order to avoid
     # to avoid foreign key errors
+    __drop_phylostrata__(cur)
+    cur.execute("DROP TABLE IF EXISTS BlastCheckpoint")
+    cur.execute("DROP TABLE IF EXISTS BestHits")
+    cur.execute("DROP TABLE IF EXISTS HspAlignment")
     cur.execute("DROP TABLE IF EXISTS Hsp")
     cur.execute("DROP TABLE IF EXISTS Hit")
+    cur.execute("DROP TABLE IF EXISTS Subject")
     cur.execute("DROP TABLE IF EXISTS Iteration")
     cur.execute("DROP TABLE IF EXISTS BlastOutput")
     cur.execute("DROP TABLE IF EXISTS BlastCollection")
@@ -152,34 +224,116 @@ def __init_blast__(cur):
     cur.execute("CREATE TABLE BlastCollection(" + COLLECTION_VAL + ")")
     cur.execute("CREATE TABLE BlastOutput(" + BLAST_VAL + ")")
     cur.execute("CREATE TABLE Iteration(" + ITERATION_VAL + ")")
+    cur.execute("CREATE TABLE Subject(" + SUBJECT_VAL + ")")
     cur.execute("CREATE TABLE Hit(" + HIT_VAL + ")")
     cur.execute("CREATE TABLE Hsp(" + HSP_VAL + ")")
+    cur.execute("CREATE TABLE HspAlignment(" + ALIGNMENT_VAL + ")")
+    cur.execute("CREATE TABLE BestHits(" + BESTHITS_VAL + ")")
+    cur.execute("CREATE TABLE BlastCheckpoint(" + CHECKPOINT_VAL + ")")
 
+    # Indices on parent keys and lookup columns. Hsp_parent_score covers
+    # the best score of each hit. blast --fast_load drops these while it
+    # loads and rebuilds them afterwards.
+    cur.execute("CREATE INDEX BlastOutput_parent ON BlastOutput(parent)")
+    cur.execute("CREATE INDEX BlastOutput_db ON BlastOutput(db)")
+    cur.execute("CREATE INDEX Iteration_parent ON Iteration(parent)")
+    cur.execute("CREATE INDEX Iteration_query_ID ON Iteration(query_ID)")
+    cur.execute("CREATE INDEX Iteration_query_def ON Iteration(query_def)")
+    cur.execute("CREATE INDEX Hit_parent ON Hit(parent)")
+    cur.execute("CREATE INDEX Hit_subject ON Hit(subject)")
+    cur.execute("CREATE INDEX Hsp_parent_score ON Hsp(parent, bit_score)")
 
+    __init_phylostrata__(cur)
 
-def __init_dbinfo__(cur):
-    DATABASE_VAL = ','.join((
-        "database varchar primary key",
-        "taxid int not null check(taxid >= 0)",
-        "species varchar not null"
-    ))
 
+
+DATABASE_VAL = ','.join((
+    "database varchar primary key",
+    "taxid int not null check(taxid >= 0)",
+    "species varchar not null"
+))
+
+def __init_dbinfo__(cur):
+    __drop_phylostrata__(cur)
     cur.execute("DROP TABLE IF EXISTS BlastDatabase")
     cur.execute("CREATE TABLE BlastDatabase(" + DATABASE_VAL + ")")
+    __init_phylostrata__(cur)
 
 
 
-def __init_mrca__(cur):
-    MRCA_VAL = ','.join((
-        "focal_taxid  int not null check(focal_taxid >= 0)",
-        "outer_taxid  int not null check(outer_taxid >= 0)",
-        "mrca_taxid   int not null check(mrca_taxid >= 0)",
-        "phylostratum int not null check(phylostratum >= 0)",
-        "mrca_name    varchar not null",
-        "primary key(focal_taxid, outer_taxid)"
-    ))
+MRCA_VAL = ','.join((
+    "focal_taxid  int not null check(focal_taxid >= 0)",
+    "outer_taxid  int not null check(outer_taxid >= 0)",
+    "mrca_taxid   int not null check(mrca_taxid >= 0)",
+    "phylostratum int not null check(phylostratum >= 0)",
+    "mrca_name    varchar not null",
+    "primary key(focal_taxid, outer_taxid)"
+))
 
+def __init_mrca__(cur):
+    __drop_phylostrata__(cur)
     cur.execute("DROP TABLE IF EXISTS MRCA")
     cur.execute("CREATE TABLE MRCA(" + MRCA_VAL + ")")
+    __init_phylostrata__(cur)
+
+
+
+# Phylostrata are materialized from BestHits, BlastDatabase and MRCA, so
+# they are cleared whenever one of them is
+def __drop_phylostrata__(cur):
+    cur.execute("DROP TABLE IF EXISTS Phylostrata")
+    cur.execute("DROP TABLE IF EXISTS QueryStratum")
+
+# Best score and phylostratum of each Iteration (query against database)
+QUERYSTRATUM_VAL = ','.join((
+    "iteration    integer primary key",
+    "query        varchar not null",
+    "phylostratum int     not null check(phylostratum >= 0)",
+    "score        float   not null check(score >= 0)",
+    """foreign key(iteration) references Iteration(sid)
+        on delete cascade
+        on update cascade"""
+))
+
+# Minimum phylostratum of each query at a given score cutoff, null if
+# no database is matched above the cutoff
+PHYLOSTRATA_VAL = ','.join((
+    "query        varchar not null",
+    "cutoff       float   not null",
+    "phylostratum int     check(phylostratum >= 0)",
+    "primary key(query, cutoff)"
+))
+
+def __init_phylostrata__(cur):
+    __drop_phylostrata__(cur)
+    cur.execute("CREATE TABLE QueryStratum(" + QUERYSTRATUM_VAL + ")")
+    cur.execute("CREATE TABLE Phylostrata(" + PHYLOSTRATA_VAL + ")")
+    cur.execute("CREATE INDEX QueryStratum_query ON QueryStratum(query)")
+
+
+
+# Table definitions by table name
+TABLES = {'BlastCollection': COLLECTION_VAL,
+          'BlastOutput':     BLAST_VAL,
+          'Iteration':       ITERATION_VAL,
+          'Subject':         SUBJECT_VAL,
+          'Hit':             HIT_VAL,
+          'Hsp':             HSP_VAL,
+          'HspAlignment':    ALIGNMENT_VAL,
+          'BestHits':        BESTHITS_VAL,
+          'BlastCheckpoint': CHECKPOINT_VAL,
+          'BlastDatabase':   DATABASE_VAL,
+          'MRCA':            MRCA_VAL,
+          'QueryStratum':    QUERYSTRATUM_VAL,
+          'Phylostrata':     PHYLOSTRATA_VAL}
 
+NUMERIC = {'int': int, 'integer': int, 'tinyint': int, 'float': float}
 
+# Returns a dict with the Python type (int or float) of each numeric column
+# of a table, read from its definition above
+def column_types(table):
+    types = {}
+    for column, kind in re.findall(r'(?:^|,)\s*(\w+)\s+(\w+)', TABLES[table]):
+        if(kind in NUMERIC):
+            types[column] = NUMERIC[kind]
+    return(types)
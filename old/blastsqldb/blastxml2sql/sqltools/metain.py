@@ -2,9 +2,12 @@
 
 import argparse
 import csv
+import os
 import sqlite3 as sql
 import sys
 import sqltools.misctools as misc
+import sqltools.retrieval as retrieval
+import sqltools.taxonomy as taxonomy
 
 def parse(parser):
 	parser.add_argument(
@@ -13,11 +16,55 @@ def parse(parser):
                 default=';')
 	parser.set_defaults(func=__metain__)
 
+# Loads database;taxid;species rows into BlastDatabase, replacing existing
+# rows, so a review file written by 'taxonomy dbinfo' can be loaded once the
+# taxids are filled in. Rows without a taxid are skipped; a missing species
+# is taken from the local taxonomy, if one is loaded. The cached phylostrata
+# of a database that is added or whose taxid changes are dropped, since its
+# iterations may now match a different taxid.
 def __metain__(args):
-    with args.input as f:
-        reader = csv.DictReader(f, delimiter=args.delimiter)
-        filename = misc.set_db_path(args.sqldb)
-        with sql.connect(filename) as con:
-            cursor = con.cursor()
-            for line in reader:
-                misc.insert(line, 'BlastDatabase', cursor)
+    if(isinstance(args.input, str)):
+        f = open(args.input, newline='')
+    else:
+        f = args.input
+    with f:
+        rows = [line for line in csv.DictReader(f, delimiter=args.delimiter)]
+    skipped = [line['database'] for line in rows if not line.get('taxid')]
+    rows = [line for line in rows if line.get('taxid')]
+    for db in skipped:
+        print("No taxid given for '{}', skipping".format(db), file=sys.stderr)
+
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    con.create_function('basename', 1, os.path.basename)
+    with con:
+        cursor = con.cursor()
+        try:
+            cursor.execute("SELECT database, taxid FROM BlastDatabase")
+            taxids = dict(cursor.fetchall())
+        except sql.OperationalError:
+            taxids = {}
+        blank = [int(line['taxid']) for line in rows if not line.get('species')]
+        try:
+            names = taxonomy.taxid2sciname(cursor, blank)
+        except sql.OperationalError:
+            names = {}
+        for line in rows:
+            if(not line.get('species')):
+                line['species'] = names.get(int(line['taxid']), '')
+            try:
+                if(taxids.get(line['database']) != int(line['taxid'])):
+                    __drop_strata__(cursor, line['database'])
+                cursor.execute(misc.insert_cmd('BlastDatabase', line.keys(), replace=True),
+                               tuple(line.values()))
+            except Exception as e:
+                print(e)
+                sys.exit(1)
+    con.close()
+
+def __drop_strata__(cursor, database):
+    try:
+        retrieval.drop_strata(cursor, database)
+    except sql.OperationalError:
+        # No BLAST or phylostrata tables, nothing is cached
+        pass
@@ -1,20 +1,144 @@
 #! /usr/bin/python3
 
 import sqlite3 as sql
-import os, os.path, sys, argparse
+import os, os.path, re, sys, argparse
+import zlib
+import sqltools.stats as stats
 
-# Builds an INSERT SQL command from a dict input (columns as keys)
+# Builds a parameterized INSERT SQL command for the given columns
+def insert_cmd(table, col, replace=False):
+    return(''.join(("INSERT OR REPLACE INTO " if replace else "INSERT INTO ", table,
+                    " (", ','.join(col), ") ",
+                    " VALUES(", ','.join('?' * len(col)), ");")))
+
+# Inserts a dict (columns as keys) as a single row, returns the new rowid
 def insert(dic, table, cur):
-    row = list(map(str, dic.values()))
-    col = list(map(str, dic.keys()))
-    sqlcmd = ''.join(("INSERT INTO ", table,
-                      " (", ','.join(col), ") ",
-                      " VALUES('", "','".join(row), "');"))    
+    sqlcmd = insert_cmd(table, dic.keys())
     try:
-        cur.execute(sqlcmd)
+        cur.execute(sqlcmd, tuple(dic.values()))
     except Exception as e:
         print(e)
         sys.exit(1)
+    return(cur.lastrowid)
+
+# Buffers rows (dicts with columns as keys) and writes them with one
+# executemany call per table and column set once batch_size rows have
+# accumulated. Tables are flushed in the order they were first seen, so
+# parents added before their children are written first. Since buffered rows
+# have no rowid yet, parent links must use keys pre-assigned with next_key.
+class BulkInsert:
+    def __init__(self, cur, batch_size=10000):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.rows = {}
+        self.nrows = 0
+        self.keys = {}
+        self.flushes = 0
+
+    # Returns the next unused integer key of a table
+    def next_key(self, table, key='sid'):
+        if(table not in self.keys):
+            self.cur.execute("SELECT ifnull(max({}), 0) FROM {}".format(key, table))
+            self.keys[table] = self.cur.fetchone()[0]
+        self.keys[table] += 1
+        return(self.keys[table])
+
+    def add(self, dic, table):
+        col = tuple(dic.keys())
+        self.rows.setdefault(table, {}).setdefault(col, []).append(tuple(dic.values()))
+        self.nrows += 1
+        if(self.nrows >= self.batch_size):
+            self.flush()
+
+    def flush(self):
+        for table, batches in self.rows.items():
+            for col, rows in batches.items():
+                try:
+                    self.cur.executemany(insert_cmd(table, col), rows)
+                except Exception as e:
+                    print(e)
+                    sys.exit(1)
+            batches.clear()
+        self.nrows = 0
+        self.flushes += 1
+
+# Alignment strings are stored compressed in the HspAlignment table. The
+# inflate function is registered on connections made by fetch, so they can
+# be read back with e.g. 'SELECT inflate(qseq) FROM HspAlignment'.
+def deflate(text):
+    return(zlib.compress(text.encode()))
+
+def inflate(blob):
+    if(blob is None): return(None)
+    return(zlib.decompress(blob).decode())
+
+# Pragmas that trade durability for speed during bulk loads. A crash
+# mid-load may corrupt the database, so they are only set for the duration
+# of a load and reverted afterwards. Sizes are given in MiB.
+def fast_load_pragmas(cache_size=256, mmap_size=1024):
+    return({'journal_mode': 'WAL',
+            'synchronous': 'OFF',
+            'foreign_keys': 'OFF',
+            'cache_size': -1024 * cache_size,
+            'mmap_size': 1048576 * mmap_size})
+
+# Sets the given pragmas, returns their previous values so they can be
+# restored by calling this function again
+def set_pragmas(cur, pragmas):
+    old = {}
+    for key, value in pragmas.items():
+        old[key] = cur.execute("PRAGMA " + key).fetchone()[0]
+        cur.execute("PRAGMA {} = {}".format(key, value))
+    return(old)
+
+# Indices dropped for a fast load are recorded here until they are created
+# again, so that a load which was killed has them restored by the next one
+DROPPED_VAL = ','.join((
+    "name varchar primary key",
+    "tbl  varchar not null",
+    "sql  varchar not null"
+))
+
+# Drops the explicitly created indices on the given tables, returns the SQL
+# needed to recreate them, along with that of indices still missing after an
+# interrupted fast load
+def drop_indices(cur, tables):
+    cur.execute("CREATE TABLE IF NOT EXISTS DroppedIndex(" + DROPPED_VAL + ")")
+    cur.execute("SELECT name, tbl_name, sql FROM sqlite_master " +
+                "WHERE type = 'index' AND sql IS NOT NULL " +
+                "AND tbl_name IN ({})".format(','.join('?' * len(tables))),
+                tuple(tables))
+    indices = cur.fetchall()
+    cur.executemany("INSERT OR REPLACE INTO DroppedIndex (name, tbl, sql) VALUES(?,?,?)",
+                    indices)
+    cur.connection.commit()
+    for name, table, cmd in indices:
+        cur.execute("DROP INDEX " + name)
+    return(__dropped__(cur, tables))
+
+# Creates indices returned by drop_indices, unless they exist already
+def create_indices(cur, indices):
+    for cmd in indices:
+        cur.execute(re.sub('^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', cmd))
+        cur.execute("DELETE FROM DroppedIndex WHERE sql = ?", (cmd,))
+    cur.connection.commit()
+
+# Creates the indices on the given tables that an interrupted fast load left
+# dropped
+def restore_indices(cur, tables):
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'DroppedIndex'")
+    if(not cur.fetchall()):
+        return
+    indices = __dropped__(cur, tables)
+    if(indices):
+        print("Restoring {} indices dropped by an interrupted fast load".format(len(indices)),
+              file=sys.stderr)
+        create_indices(cur, indices)
+
+def __dropped__(cur, tables):
+    cur.execute("SELECT sql FROM DroppedIndex " +
+                "WHERE tbl IN ({})".format(','.join('?' * len(tables))), tuple(tables))
+    return([row[0] for row in cur.fetchall()])
 
 # Given a SQL database filename, builds a path to the correct location
 # in the package homefolder
@@ -29,17 +153,35 @@ def set_db_path(filename):
         dbfile = os.path.join(path, tail)
         return(dbfile)
 
-# Submit a sql cmd
-def fetch(cmd, dbname):
+# Connects to a SQL database, its SQL calls are counted for --stats
+def connect(filename):
+    return(sql.connect(filename, factory=stats.Connection))
+
+# Submit a sql cmd. Returns the column names and an iterator over lists of
+# at most size rows, so that results of any size are streamed rather than
+# held in memory. Commands without results are committed right away.
+def fetch(cmd, dbname, size=10000):
     db = set_db_path(dbname)
-    con = sql.connect(db)
-    with con:
-        cur = con.cursor()
-        try:
-            cur.execute(cmd)
-            result = cur.fetchall()
-        except Exception as e:
-            print(e)
-            sys.exit(1)
-    return(result)
+    con = connect(db)
+    con.create_function('inflate', 1, inflate)
+    cur = con.cursor()
+    try:
+        cur.execute(cmd)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    if(cur.description is None):
+        con.commit()
+        con.close()
+        return([], iter(()))
+    return([d[0] for d in cur.description], __chunks__(con, cur, size))
 
+def __chunks__(con, cur, size):
+    try:
+        while(True):
+            rows = cur.fetchmany(size)
+            if(not rows):
+                break
+            yield(rows)
+    finally:
+        con.close()
@@ -1,9 +1,23 @@
 #! /usr/bin/python3
 
 import argparse
+import csv
+import json
+import os
+import pickle
+import sqlite3 as sql
 import sys
+import tempfile
+import zipfile
+import sqltools.besthits as besthits
+import sqltools.fasta as fasta
 import sqltools.misctools as misc
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def parse(parser):
 
     parser.add_argument(
@@ -21,6 +35,27 @@ def parse(parser):
         'raw',
         help="Submit raw SQLite command")
     raw.add_argument('sqlcmd')
+    raw.add_argument(
+        '-f', '--format',
+        help=
+            """
+            Output format: delimited text (csv, with --delimiter), tsv,
+            JSON lines (json) or a NumPy .npz archive with one array per
+            column (npz, needs --output) (default=csv)
+            """,
+        choices=('csv', 'tsv', 'json', 'npz'),
+        default='csv')
+    raw.add_argument(
+        '-o', '--output',
+        help="output file (default: stdout)")
+    raw.add_argument(
+        '-H', '--no_header',
+        help="leave out the header line of csv and tsv output",
+        default=False, action='store_true')
+    raw.add_argument(
+        '-b', '--batch_size',
+        help="number of rows fetched at a time (default=10000)",
+        type=int, default=10000)
 
     mat = sub.add_parser(
         'mat',
@@ -36,26 +71,372 @@ def parse(parser):
     mat.add_argument(
         '-c', '--collection',
         help="Blast collection")
+    mat.add_argument(
+        '-n', '--npy',
+        help=
+            """
+            Also write the matrix as a dense NumPy .npy file (rows and
+            columns ordered as in the CSV output, missing values are NaN)
+            """)
+
+    ps = sub.add_parser(
+        'phylostrata',
+        help="Fetch the phylostratum of each query")
+    ps.add_argument(
+        '-s', '--score',
+        help="Minimum summed bit score of a best hit (default=100)",
+        type=float,
+        default=100)
+
+    seqs = sub.add_parser(
+        'seqs',
+        help="Fetch the query sequences from the FASTA file BLAST was run on")
+    seqs.add_argument(
+        'fasta',
+        help="query FASTA file, indexed on first use")
+    seqs.add_argument(
+        '-c', '--collection',
+        help="Blast collection")
+
+    sub.add_parser(
+        'plan',
+        help="Check that the canned queries use the BLAST table indices")
 
     parser.set_defaults(func=__dispatch__)
 
 def __dispatch__(args):
     call = {'raw': __fetch_and_print__,
-            'mat': __score_matrix__}
+            'mat': __score_matrix__,
+            'phylostrata': __phylostrata__,
+            'seqs': __query_sequences__,
+            'plan': __check_plans__}
     call[args.retrieval_function](args)
 
 
+# Streams the result of a raw command, one batch of rows at a time, so
+# memory use does not grow with the size of the result
 def __fetch_and_print__(args):
-    rows = misc.fetch(args.sqlcmd, args.sqldb)
-    for row in rows:
-        print((args.delimiter).join(map(str, row)))
+    if('npz' == args.format and (np is None or not args.output)):
+        print("npz output requires numpy and an --output file")
+        sys.exit(1)
+    columns, chunks = misc.fetch(args.sqlcmd, args.sqldb, args.batch_size)
+    if('npz' == args.format):
+        __write_npz__(columns, chunks, args.output)
+        return
+    if(args.output):
+        out = open(args.output, 'w', newline='', buffering=2 ** 20)
+    else:
+        out = open(sys.stdout.fileno(), 'w', newline='', buffering=2 ** 20, closefd=False)
+    with out:
+        if('json' == args.format):
+            names = __unique_names__(columns)
+            for rows in chunks:
+                out.write(''.join(json.dumps(dict(zip(names, row)), default=__bytes_to_hex__) +
+                                  '\n' for row in rows))
+            return
+        delimiter = '\t' if 'tsv' == args.format else args.delimiter
+        writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+        if(columns and not args.no_header):
+            writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+
+# Column names made unique by appending '_', e.g. to the second sid of a
+# join, as JSON objects and npz members need distinct keys
+def __unique_names__(columns):
+    names = []
+    for name in columns:
+        while(name in names):
+            name += '_'
+        names.append(name)
+    return(names)
+
+def __bytes_to_hex__(value):
+    if(isinstance(value, bytes)):
+        return(value.hex())
+    raise TypeError("Cannot write {} as JSON".format(type(value).__name__))
+
+# Kind of a batch of one column, the first of str, bytes, float and int
+# found in it, None if it only holds nulls
+def __column_kind__(values):
+    types = set(map(type, values))
+    for kind in (str, bytes, float, int):
+        if(kind in types):
+            return(kind)
+    return(None)
+
+# Converts a batch of one column to an array of the column's kind. Nulls
+# become '' in text columns and NaN in numeric ones, so integer columns with
+# nulls are stored as float.
+def __column_array__(values, kind, nulls):
+    if(kind is str):
+        return(np.array(['' if v is None else str(v) for v in values]))
+    if(kind is bytes):
+        return(np.array([b'' if v is None else v if isinstance(v, bytes) else str(v).encode()
+                         for v in values]))
+    if(kind is float or nulls):
+        return(np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+    return(np.array(values, dtype=np.int64))
+
+# Width of a batch of one column written as text or bytes
+def __width__(values, kind):
+    return(__column_array__(values, kind, True).dtype.itemsize // (4 if kind is str else 1))
+
+# Type of a column from its kind and the widths of its batches
+def __column_dtype__(kind, nulls, widths):
+    if(kind is str):
+        return(np.dtype('U{}'.format(max(widths))))
+    if(kind is bytes):
+        return(np.dtype('S{}'.format(max(widths))))
+    if(kind is int and not nulls):
+        return(np.dtype(np.int64))
+    return(np.dtype(np.float64))
 
+# Writes one .npy member per column, as np.savez does, without holding the
+# columns in memory. The batches of each column are kept in a temporary file
+# until the kind of the column is known from all of them, the members are
+# then written batch by batch.
+def __write_npz__(columns, chunks, output):
+    names = __unique_names__(columns)
+    order = (None, int, float, bytes, str)
+    kinds = [None] * len(names)
+    nulls = [False] * len(names)
+    batches = [[] for name in names]
+    nrows = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [open(os.path.join(tmp, str(i)), 'w+b') for i in range(len(names))]
+        for rows in chunks:
+            nrows += len(rows)
+            for i, values in enumerate(zip(*rows)):
+                kind = __column_kind__(values)
+                kinds[i] = max(kinds[i], kind, key=order.index)
+                nulls[i] = nulls[i] or None in values
+                batches[i].append((kind, __width__(values, kind) if kind in (str, bytes) else 0))
+                pickle.dump(values, files[i])
+        with zipfile.ZipFile(output, 'w', allowZip64=True) as npz:
+            for name, f, kind, null, parts in zip(names, files, kinds, nulls, batches):
+                if(kind in (str, bytes) and {k for k, w in parts} - {None, kind}):
+                    # Batches of another kind are read twice to find their width
+                    f.seek(0)
+                    parts = [(kind, __width__(pickle.load(f), kind)) for part in parts]
+                dtype = __column_dtype__(kind, null, [w for k, w in parts])
+                header = {'descr': np.lib.format.dtype_to_descr(dtype),
+                          'fortran_order': False, 'shape': (nrows,)}
+                f.seek(0)
+                with npz.open(name + '.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array_header_1_0(member, header)
+                    for part in parts:
+                        array = __column_array__(pickle.load(f), kind, null)
+                        member.write(array.astype(dtype).tobytes())
+                f.close()
+
+QUERIES = "FROM Iteration INNER JOIN BlastOutput ON Iteration.parent = BlastOutput.sid "
+
+# SQLite takes the bare column (the filling) from the row holding max()
+def __matrix_cmd__(filling, cond=""):
+    return("SELECT query_def, db, max(Hsp.bit_score), Hsp.{} ".format(filling) +
+           QUERIES +
+           "LEFT JOIN Hit ON Hit.parent = Iteration.sid " +
+           "LEFT JOIN Hsp ON Hsp.parent = Hit.sid " + cond +
+           " GROUP BY query_def, db ORDER BY query_def")
+
+# Writes a query by database matrix filled with the chosen field of the
+# highest scoring hsp of each pair. The matrix is built by one grouped query
+# ordered by query, so each row is written as soon as it is complete and only
+# one row is held in memory.
 def __score_matrix__(args):
-    print("stub")
-#    sqlcmd = 
-#        """
-#        
-#        """
+    if(args.npy and np is None):
+        print("Writing .npy files requires numpy")
+        sys.exit(1)
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    cur = con.cursor()
+
+    fields = [row[1] for row in cur.execute("PRAGMA table_info(Hsp)")]
+    if(args.filling not in fields):
+        print("'{}' is not a field of the Hsp table".format(args.filling))
+        sys.exit(1)
+
+    cond, param = ("", ())
+    if(args.collection):
+        cond, param = ("WHERE BlastOutput.parent = ?", (args.collection,))
+
+    cur.execute("SELECT DISTINCT db FROM BlastOutput {} ORDER BY db".format(cond), param)
+    databases = [row[0] for row in cur.fetchall()]
+    column = {db: i for i, db in enumerate(databases)}
+
+    if(args.npy):
+        cur.execute("SELECT count(DISTINCT query_def) " + QUERIES + cond, param)
+        mat = np.lib.format.open_memmap(args.npy, mode='w+', dtype=np.float64,
+                                        shape=(cur.fetchone()[0], len(databases)))
+        mat[:] = np.nan
+
+    cur.execute(__matrix_cmd__(args.filling, cond), param)
+
+    # csv quotes query names that hold the delimiter or quotes
+    out = csv.writer(sys.stdout, delimiter=args.delimiter, lineterminator='\n')
+    out.writerow([''] + [os.path.basename(x) for x in databases])
+    query, row, nrows = (None, None, 0)
+    for q, db, score, value in cur:
+        if(q != query):
+            if(query is not None):
+                __write_matrix_row__(out, args, query, row, mat if args.npy else None, nrows)
+                nrows += 1
+            query, row = (q, [None] * len(databases))
+        row[column[db]] = value
+    if(query is not None):
+        __write_matrix_row__(out, args, query, row, mat if args.npy else None, nrows)
+    if(args.npy):
+        mat.flush()
+    con.close()
 
+def __write_matrix_row__(out, args, query, row, mat, i):
+    out.writerow([query] + ['NA' if x is None else x for x in row])
+    if(mat is not None):
+        mat[i] = [np.nan if x is None else x for x in row]
+
+# Prints the sequence of each query in FASTA format. Queries are looked up in
+# the offset index of the FASTA file by the first word of their definition,
+# or else by their ID, so only the needed sequences are read.
+def __query_sequences__(args):
+    fasta.check_numpy()
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    cur = con.cursor()
+
+    cond, param = ("", ())
+    if(args.collection):
+        cond, param = ("WHERE BlastOutput.parent = ?", (args.collection,))
+    cur.execute("SELECT DISTINCT query_def, query_ID " + QUERIES + cond +
+                " ORDER BY query_def", param)
+    queries = cur.fetchall()
+    con.close()
+
+    try:
+        reader = fasta.Fasta(args.fasta)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    with reader:
+        names = []
+        for query_def, query_id in queries:
+            words = query_def.split(None, 1)
+            if(words and words[0] in reader):
+                names.append(words[0])
+            else:
+                names.append(query_id)
+        seqs = reader.fetch(names)
+
+    for (query_def, query_id), name in zip(queries, names):
+        if(name not in seqs):
+            print("No sequence found for query '{}'".format(query_def), file=sys.stderr)
+            continue
+        sys.stdout.write(">{}\n{}\n".format(query_def, seqs[name]))
+
+# Best hits of new iterations whose query and database taxa have an MRCA.
+# Databases are matched to BlastDatabase by path or by file name; if both
+# are listed, the row holding the path is used, so each iteration gets one
+# row.
+NEW_STRATA = """
+    SELECT BestHits.iteration, Iteration.query_def, MRCA.phylostratum, BestHits.bit_score
+    FROM BestHits
+    INNER JOIN Iteration ON BestHits.iteration = Iteration.sid
+    INNER JOIN BlastOutput ON Iteration.parent = BlastOutput.sid
+    INNER JOIN BlastDatabase ON BlastDatabase.database = coalesce(
+        (SELECT database FROM BlastDatabase AS Exact WHERE Exact.database = BlastOutput.db),
+        basename(BlastOutput.db))
+    INNER JOIN MRCA
+        ON MRCA.focal_taxid = BlastOutput.query_taxid
+        AND MRCA.outer_taxid = BlastDatabase.taxid
+    WHERE BestHits.iteration NOT IN (SELECT iteration FROM QueryStratum)
+    """
+
+# Iterations run against a BLAST database, matched by path or by file name
+ITERATIONS_OF_DB = """
+    SELECT Iteration.sid FROM Iteration
+    INNER JOIN BlastOutput ON Iteration.parent = BlastOutput.sid
+    WHERE ? IN (BlastOutput.db, basename(BlastOutput.db))
+    """
+
+# Drops the cached phylostrata of the iterations run against a database, e.g.
+# when its taxid changes. They are computed again, with the new taxid, by the
+# next 'retrieval phylostrata'. The connection needs the basename function.
+def drop_strata(cur, database):
+    cur.execute("DELETE FROM Phylostrata WHERE query IN " +
+                "(SELECT query_def FROM Iteration WHERE sid IN (" + ITERATIONS_OF_DB + "))",
+                (database,))
+    cur.execute("DELETE FROM QueryStratum WHERE iteration IN (" + ITERATIONS_OF_DB + ")",
+                (database,))
+
+# Phylostrata are computed in two materialized steps. QueryStratum caches the
+# best score and phylostratum of every (query, database) pair; only pairs
+# from new reports, or newly resolvable through new BlastDatabase and MRCA
+# rows, are added, and the cached phylostrata of their queries are dropped.
+# Phylostrata then holds the minimum phylostratum per query and cutoff,
+# computed from QueryStratum only for queries not yet cached at the cutoff,
+# so sweeping over cutoffs never rescans the hsps.
+def __phylostrata__(args):
+    besthits.check_numpy()
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    con.create_function('basename', 1, os.path.basename)
+    with con:
+        cur = con.cursor()
+        besthits.update(cur)
+        cur.execute("CREATE TEMP TABLE NewStratum AS " + NEW_STRATA)
+        cur.execute("INSERT INTO QueryStratum SELECT * FROM NewStratum")
+        cur.execute("DELETE FROM Phylostrata WHERE query IN " +
+                    "(SELECT query_def FROM NewStratum)")
+        cur.execute("DROP TABLE NewStratum")
+        cur.execute(
+            """
+            INSERT INTO Phylostrata
+            SELECT query, ?, min(CASE WHEN score > ? THEN phylostratum END)
+            FROM QueryStratum
+            WHERE query NOT IN (SELECT query FROM Phylostrata WHERE cutoff = ?)
+            GROUP BY query
+            """, (args.score, args.score, args.score))
+    cur.execute("SELECT query, phylostratum FROM Phylostrata " +
+                "WHERE cutoff = ? ORDER BY query", (args.score,))
+    for query, phylostratum in cur:
+        print(args.delimiter.join((query, 'NA' if phylostratum is None else str(phylostratum))))
+    con.close()
 
+# Queries run by the sqltools commands or typical of per-locus lookups, with
+# example parameters and the tables they are expected to scan in full. Any
+# other full table scan means an index is missing or not used.
+HSPS_OF = ("FROM Iteration INNER JOIN Hit ON Hit.parent = Iteration.sid " +
+           "INNER JOIN Hsp ON Hsp.parent = Hit.sid ")
+CANNED = (
+    ('locus hsps',
+        "SELECT Hsp.* " + HSPS_OF + "WHERE Iteration.query_def = ?", ('',), ()),
+    ('query_ID hsps',
+        "SELECT Hsp.* " + HSPS_OF + "WHERE Iteration.query_ID = ?", ('',), ()),
+    ('locus best score',
+        "SELECT Hit.parent, max(Hsp.bit_score) " + HSPS_OF +
+        "WHERE Iteration.query_def = ? GROUP BY Hit.parent", ('',), ()),
+    ('database queries',
+        "SELECT query_def " + QUERIES + "WHERE BlastOutput.db = ?", ('',), ()),
+    ('collection matrix',
+        __matrix_cmd__('bit_score', "WHERE BlastOutput.parent = ?"), ('',),
+        ('Iteration',)),
+    ('besthits update',
+        besthits.hsp_cmd(besthits.NEW_ITERATIONS), (0,), ())
+)
 
+def __check_plans__(args):
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    cur = con.cursor()
+    failed = False
+    for name, cmd, param, scanned in CANNED:
+        cur.execute("EXPLAIN QUERY PLAN " + cmd, param)
+        plan = [row[3] for row in cur.fetchall()]
+        scans = [x for x in plan if x.startswith('SCAN') and x.split()[1] not in scanned]
+        failed = failed or bool(scans)
+        print("{}: {}".format(name, 'FULL SCAN' if scans else 'ok'))
+        for step in plan:
+            print("    " + step)
+    con.close()
+    if(failed):
+        sys.exit(1)
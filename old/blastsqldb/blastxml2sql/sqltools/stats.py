@@ -0,0 +1,227 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# Instrumentation shared by all sub-commands. Connections made with
+# misctools.connect count and time their SQL calls and the rows inserted
+# into each table, sub-commands add the time of their own stages, and with
+# --stats a summary is written to stderr when the command exits. Counting
+# happens once per execute/executemany call, never per row, so it is cheap
+# enough to leave on.
+#
+########################################################
+
+import cProfile
+import re
+import resource
+import sqlite3 as sql
+import sys
+from contextlib import contextmanager
+from time import time
+
+def parse(parser):
+    parser.add_argument(
+        '--stats',
+        help=("report stage times, rows per table, SQL calls, bytes read and "
+              "peak memory on stderr"),
+        default=False, action='store_true')
+    parser.add_argument(
+        '--profile',
+        help="write cProfile statistics of the main process to this file (implies --stats)")
+    parser.add_argument(
+        '--progress',
+        help="print a progress line every this many seconds during loads (default=0, off)",
+        type=float, default=0)
+
+
+
+class Stats:
+    def __init__(self):
+        self.start = time()
+        self.stages = {}
+        self.stack = []
+        self.rows = {}
+        self.calls = {'execute': 0, 'executemany': 0}
+        self.changes = 0
+        self.connections = []
+        self.bytes_read = 0
+        self.interval = 0
+        self.last_progress = self.start
+
+    # Stage times are exclusive, the time of a stage entered while another
+    # one runs is taken off the outer stage
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+        if(self.stack):
+            self.stack[-1] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time()
+        self.stack.append(0)
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            self.stages[stage] = self.stages.get(stage, 0) + elapsed - self.stack.pop()
+            if(self.stack):
+                self.stack[-1] += elapsed
+
+    def add_rows(self, table, n):
+        self.rows[table] = self.rows.get(table, 0) + n
+
+    # True once every --progress seconds, when a progress line is due
+    def due(self):
+        if(not self.interval):
+            return(False)
+        now = time()
+        if(now - self.last_progress < self.interval):
+            return(False)
+        self.last_progress = now
+        return(True)
+
+    # Prints a progress line, done and total are input bytes. The ETA is
+    # left out if they are unknown.
+    def progress(self, label, iterations, done=None, total=None):
+        seconds = time() - self.start
+        line = "{}: {} iterations, {:.1f} it/s".format(label, iterations, iterations / seconds)
+        if(done is not None and total is not None):
+            line += ", {:.1f} of {:.1f} MB".format(done / 2 ** 20, total / 2 ** 20)
+            if(done > 0):
+                line += ", ETA {}".format(__duration__(seconds * (total - done) / done))
+        print(line, file=sys.stderr)
+
+    def report(self, label, out=sys.stderr):
+        total = time() - self.start
+        w = lambda *x: print(*x, sep='\t', file=out)
+        w("# stats", label)
+        w("stage", "seconds")
+        for stage, seconds in self.stages.items():
+            w(stage, "{:.3f}".format(seconds))
+        w("other", "{:.3f}".format(max(0, total - sum(self.stages.values()))))
+        w("total", "{:.3f}".format(total))
+        if(self.rows):
+            w("table", "rows inserted")
+            for table, n in sorted(self.rows.items()):
+                w(table, n)
+        w("sql calls", "{execute} execute, {executemany} executemany".format(**self.calls))
+        w("rows changed", self.changes + sum(c.total_changes for c in self.connections))
+        if(self.bytes_read):
+            w("input read", "{:.1f} MB".format(self.bytes_read / 2 ** 20))
+        io = __proc_io__()
+        if(io is not None):
+            w("process read", "{:.1f} MB".format(io / 2 ** 20))
+        w("peak rss", "{:.1f} MB".format(__maxrss__(resource.RUSAGE_SELF)))
+        children = __maxrss__(resource.RUSAGE_CHILDREN)
+        if(children):
+            w("peak rss children", "{:.1f} MB".format(children))
+
+# The statistics of this command
+current = Stats()
+
+
+
+def start(args):
+    current.interval = getattr(args, 'progress', 0)
+    if(getattr(args, 'profile', None)):
+        current.profiler = cProfile.Profile()
+        current.profiler.enable()
+
+def finish(args, label):
+    if(getattr(args, 'profile', None)):
+        current.profiler.disable()
+        current.profiler.dump_stats(args.profile)
+    if(getattr(args, 'stats', False) or getattr(args, 'profile', None)):
+        current.report(label)
+
+
+
+# Counts and times the SQL calls of its connection. Time spent fetching rows
+# is counted for the fetch methods, not for iterating over the cursor.
+class Cursor(sql.Cursor):
+    def execute(self, *args):
+        start = time()
+        try:
+            return(super().execute(*args))
+        finally:
+            __count__(self, 'execute', args[0], start)
+
+    def executemany(self, *args):
+        start = time()
+        try:
+            return(super().executemany(*args))
+        finally:
+            __count__(self, 'executemany', args[0], start)
+
+    def fetchone(self):
+        with current.timer('sql'):
+            return(super().fetchone())
+
+    def fetchmany(self, *args):
+        with current.timer('sql'):
+            return(super().fetchmany(*args))
+
+    def fetchall(self):
+        with current.timer('sql'):
+            return(super().fetchall())
+
+class Connection(sql.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        current.connections.append(self)
+
+    def cursor(self, factory=Cursor):
+        return(super().cursor(factory))
+
+    def execute(self, *args):
+        return(self.cursor().execute(*args))
+
+    def executemany(self, *args):
+        return(self.cursor().executemany(*args))
+
+    def commit(self):
+        with current.timer('commit'):
+            super().commit()
+
+    def __exit__(self, *exc):
+        with current.timer('commit'):
+            return(super().__exit__(*exc))
+
+    def close(self):
+        if(self in current.connections):
+            current.connections.remove(self)
+            current.changes += self.total_changes
+        super().close()
+
+INSERT = re.compile(r'\s*(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO\s+(\w+)', re.I)
+
+def __count__(cur, kind, cmd, start):
+    current.add_time('sql', time() - start)
+    current.calls[kind] += 1
+    match = INSERT.match(cmd)
+    if(match and cur.rowcount > 0):
+        current.add_rows(match.group(1), cur.rowcount)
+
+
+
+def __duration__(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if(hours):
+        return("{}h{:02d}m".format(hours, minutes))
+    return("{}m{:02d}s".format(minutes, seconds))
+
+def __maxrss__(who):
+    # kB on Linux, bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return(rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10)
+
+# Bytes read by this process through read calls, from /proc on Linux
+def __proc_io__():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if(line.startswith('rchar:')):
+                    return(int(line.split()[1]))
+    except OSError:
+        return(None)
@@ -0,0 +1,347 @@
+#! /usr/bin/python3
+
+#######################################################
+#
+# Local copy of the NCBI taxonomy, loaded once from the names.dmp and
+# nodes.dmp files of a taxdump
+# (ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz). Scientific name and
+# lineage lookups are answered from indexed tables in the SQL database, so
+# no network access is needed.
+#
+########################################################
+
+import argparse
+import csv
+import os
+import re
+import sqlite3 as sql
+import sys
+import sqltools.entrez as entrez
+import sqltools.misctools as misc
+
+def parse(parser):
+    sub = parser.add_subparsers(
+        title="Taxonomy commands",
+        dest="taxonomy_function")
+
+    load = sub.add_parser(
+        'load',
+        help="Load (or reload) a NCBI taxdump")
+    load.add_argument(
+        'taxdump',
+        help="Directory containing names.dmp and nodes.dmp")
+
+    dbinfo = sub.add_parser(
+        'dbinfo',
+        help=("Add the species and taxid of each BLAST database, guessed "
+              "from its filename, to BlastDatabase"))
+    dbinfo.add_argument(
+        '-r', '--review',
+        help=("file listing the databases that could not be resolved, "
+              "fill in their taxids and load it with 'meta -i' "
+              "(default='unresolved_taxa.csv')"),
+        default='unresolved_taxa.csv')
+    dbinfo.add_argument(
+        '-d', '--delimiter',
+        help="review file delimiter (default=';')",
+        default=';')
+    entrez.parse(dbinfo)
+
+    mrca = sub.add_parser(
+        'mrca',
+        help=("Add the MRCA of each query taxon and BLAST database taxon "
+              "missing from the MRCA table"))
+    entrez.parse(mrca)
+
+    parser.set_defaults(func=__dispatch__)
+
+def __dispatch__(args):
+    call = {'load': __load__,
+            'dbinfo': __dbinfo__,
+            'mrca': __mrca__}
+    call[args.taxonomy_function](args)
+
+
+
+# Returns a dict mapping each name that was found to its taxid. Scientific
+# names take precedence over other name classes (synonyms, common names, ...);
+# names matching several taxa within the best class are left out.
+def sciname2taxid(cur, names):
+    names = list(set(names))
+    found = {}
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        cur.execute("SELECT name, taxid, class FROM TaxName WHERE name IN ({})".format(
+                    ','.join('?' * len(chunk))), chunk)
+        for name, taxid, cls in cur.fetchall():
+            found.setdefault(name.lower(), []).append((cls != 'scientific name', taxid))
+    out = {}
+    for name in names:
+        matches = sorted(found.get(name.lower(), []))
+        best = [taxid for rank, taxid in matches if rank == matches[0][0]]
+        if(len(set(best)) == 1):
+            out[name] = best[0]
+    return(out)
+
+# Returns a dict mapping each taxid to its lineage, a list of taxids from
+# the root down to the taxid itself. Unknown taxids are left out.
+def taxid2lineage(cur, taxids):
+    out = {}
+    for taxid in set(taxids):
+        if(taxid not in __lineages__):
+            cur.execute(LINEAGE_CMD, (taxid,))
+            __lineages__[taxid] = [row[0] for row in cur.fetchall()]
+        if(__lineages__[taxid]):
+            out[taxid] = __lineages__[taxid]
+    return(out)
+
+# Returns a dict mapping each taxid to its scientific name
+def taxid2sciname(cur, taxids):
+    taxids = list(set(taxids))
+    out = {}
+    for i in range(0, len(taxids), 500):
+        chunk = taxids[i:i + 500]
+        cur.execute("SELECT taxid, name FROM TaxName " +
+                    "WHERE class = 'scientific name' AND taxid IN ({})".format(
+                    ','.join('?' * len(chunk))), chunk)
+        out.update(cur.fetchall())
+    return(out)
+
+
+
+# Lineages looked up during this run
+__lineages__ = {}
+
+# Walks up the parent links to the root (which is its own parent)
+LINEAGE_CMD = """
+    WITH RECURSIVE up(taxid, parent, depth) AS (
+        SELECT taxid, parent, 0 FROM TaxNode WHERE taxid = ?
+        UNION ALL
+        SELECT TaxNode.taxid, TaxNode.parent, up.depth + 1
+        FROM TaxNode INNER JOIN up ON TaxNode.taxid = up.parent
+        WHERE up.taxid != up.parent
+    )
+    SELECT taxid FROM up ORDER BY depth DESC
+    """
+
+def __read_dmp__(filename, ncol):
+    with open(filename) as f:
+        for line in f:
+            yield(line.rstrip('\t|\n').split('\t|\t')[:ncol])
+
+def __load__(args):
+    names = os.path.join(args.taxdump, 'names.dmp')
+    nodes = os.path.join(args.taxdump, 'nodes.dmp')
+    for filename in (names, nodes):
+        if(not os.path.isfile(filename)):
+            print("Cannot find {}".format(filename))
+            sys.exit(1)
+
+    NODE_VAL = ','.join((
+        "taxid  integer primary key",
+        "parent int not null",
+        "rank   varchar"
+    ))
+
+    NAME_VAL = ','.join((
+        "name  varchar not null collate nocase",
+        "taxid int     not null",
+        "class varchar not null"
+    ))
+
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    with con:
+        cur = con.cursor()
+        cur.execute("DROP TABLE IF EXISTS TaxNode")
+        cur.execute("DROP TABLE IF EXISTS TaxName")
+        cur.execute("CREATE TABLE TaxNode(" + NODE_VAL + ")")
+        cur.execute("CREATE TABLE TaxName(" + NAME_VAL + ")")
+        cur.executemany("INSERT INTO TaxNode (taxid, parent, rank) VALUES(?,?,?)",
+                        ((int(t), int(p), r) for t, p, r in __read_dmp__(nodes, 3)))
+        cur.executemany("INSERT INTO TaxName (taxid, name, class) VALUES(?,?,?)",
+                        ((int(t), n, c) for t, n, u, c in __read_dmp__(names, 4)))
+        # Indices are built after loading, which is much faster
+        cur.execute("CREATE INDEX TaxName_name ON TaxName(name)")
+        cur.execute("CREATE INDEX TaxName_taxid ON TaxName(taxid)")
+    con.close()
+
+
+
+# Checks that a taxdump has been loaded, which is optional when Entrez is used
+def __has_taxonomy__(cur, args):
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='TaxName'")
+    if(cur.fetchall()):
+        return(True)
+    if(not args.entrez):
+        print("No local taxonomy, run 'taxonomy load' first or use --entrez")
+        sys.exit(1)
+    return(False)
+
+# Runs an Entrez lookup, exiting on network errors
+def __remote__(lookup, keys, args):
+    try:
+        return(lookup(keys, entrez.client(args)))
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+# Candidate taxon names for a database filename, most specific first, e.g.
+# 'Brassica_rapa_subsp_pekinensis_v2.faa' -> 'Brassica rapa subsp. pekinensis v2',
+# 'Brassica rapa subsp pekinensis v2', 'Brassica rapa subsp. pekinensis', ...,
+# 'Brassica rapa'. Rank abbreviations get their dots back, as in the old
+# guess_scinames script, and trailing words are dropped down to a binomial.
+def __guess_names__(database):
+    name = re.sub(r"\..*", "", os.path.basename(database))
+    words = [w for w in name.split('_') if w]
+    dotted = [w + '.' if w in ('var', 'sp', 'subsp', 'cv') and i < len(words) - 1
+              else w for i, w in enumerate(words)]
+    names = []
+    for n in range(len(words), 1, -1):
+        for candidate in (dotted[:n], words[:n]):
+            candidate = ' '.join(candidate).rstrip('.')
+            if(candidate not in names):
+                names.append(candidate)
+    return(names or [' '.join(words)])
+
+# Resolves all new databases in one pass. Databases that cannot be resolved
+# are written to the review file, in the format read by 'meta', so the run
+# never stops to ask.
+def __dbinfo__(args):
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    with con:
+        cur = con.cursor()
+        cur.execute("SELECT DISTINCT db FROM BlastOutput")
+        databases = {os.path.basename(row[0]) for row in cur.fetchall()}
+        # A database may be listed by path or by file name, either one counts
+        cur.execute("SELECT database FROM BlastDatabase")
+        databases -= {os.path.basename(row[0]) for row in cur.fetchall()}
+
+        guesses = {db: __guess_names__(db) for db in databases}
+        taxids = {}
+        if(__has_taxonomy__(cur, args)):
+            taxids = sciname2taxid(cur, [n for names in guesses.values() for n in names])
+        if(args.entrez):
+            missing = [n for names in guesses.values()
+                       if not any(n in taxids for n in names) for n in names]
+            if(missing):
+                taxids.update(__remote__(entrez.sciname2taxid, missing, args))
+        rows = []
+        unresolved = []
+        for db in sorted(databases):
+            found = [n for n in guesses[db] if n in taxids]
+            if(found):
+                rows.append((db, taxids[found[0]], found[0]))
+            else:
+                unresolved.append((db, '', guesses[db][0]))
+        cur.executemany(misc.insert_cmd('BlastDatabase', ('database', 'taxid', 'species')),
+                        rows)
+    con.close()
+
+    print("{} databases resolved, {} unresolved".format(len(rows), len(unresolved)),
+          file=sys.stderr)
+    if(unresolved):
+        with open(args.review, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter=args.delimiter)
+            writer.writerow(('database', 'taxid', 'species'))
+            writer.writerows(unresolved)
+        print("Unresolved databases written to {}".format(args.review), file=sys.stderr)
+
+
+# Lowest common ancestor index over the tree spanned by a set of lineages.
+# The tree is laid out as an Euler tour, after which the LCA of two taxa is
+# the shallowest taxon visited between their first visits, found in O(1)
+# from a sparse table of range minima.
+class LCA:
+    def __init__(self, lineages):
+        children = {}
+        self.depth = {}
+        for lineage in lineages:
+            for i, taxid in enumerate(lineage):
+                self.depth[taxid] = i
+                if(i > 0):
+                    children.setdefault(lineage[i - 1], set()).add(taxid)
+
+        # Iterative depth first traversal, a taxon is visited on entry and
+        # again after each of its children
+        root = lineages[0][0]
+        tour = []
+        stack = [(root, iter(sorted(children.get(root, ()))))]
+        while(stack):
+            taxid, rest = stack[-1]
+            tour.append(taxid)
+            child = next(rest, None)
+            if(child is None):
+                stack.pop()
+            else:
+                stack.append((child, iter(sorted(children.get(child, ())))))
+
+        self.first = {}
+        for i, taxid in enumerate(tour):
+            self.first.setdefault(taxid, i)
+
+        # table[k][i] is the shallowest taxon in tour[i:i + 2**k]
+        self.table = [tour]
+        k = 1
+        while((1 << k) <= len(tour)):
+            prev = self.table[-1]
+            half = 1 << (k - 1)
+            self.table.append([self.__min__(prev[i], prev[i + half])
+                               for i in range(len(tour) - (1 << k) + 1)])
+            k += 1
+
+    def __min__(self, a, b):
+        return(a if self.depth[a] <= self.depth[b] else b)
+
+    def __call__(self, a, b):
+        i, j = sorted((self.first[a], self.first[b]))
+        k = (j - i + 1).bit_length() - 1
+        return(self.__min__(self.table[k][i], self.table[k][j - (1 << k) + 1]))
+
+# Adds a row to MRCA for each (query taxon, database taxon) pair that does
+# not have one yet. The phylostratum is the depth of the MRCA below the root.
+def __mrca__(args):
+    filename = misc.set_db_path(args.sqldb)
+    con = misc.connect(filename)
+    with con:
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MRCA'")
+        if(not cur.fetchall()):
+            print("No MRCA table, run 'init --mrca' first")
+            sys.exit(1)
+
+        cur.execute("SELECT DISTINCT query_taxid FROM BlastOutput " +
+                    "WHERE query_taxid IS NOT NULL")
+        focal = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT DISTINCT taxid FROM BlastDatabase")
+        outer = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT focal_taxid, outer_taxid FROM MRCA")
+        done = set(cur.fetchall())
+
+        lineages = {}
+        names = {}
+        if(__has_taxonomy__(cur, args)):
+            lineages = taxid2lineage(cur, focal | outer)
+        missing = (focal | outer) - set(lineages)
+        if(args.entrez and missing):
+            remote, names = __remote__(entrez.taxid2lineage, missing, args)
+            lineages.update(remote)
+        for taxid in sorted((focal | outer) - set(lineages)):
+            print("Taxid {} is not in the taxonomy".format(taxid), file=sys.stderr)
+        pairs = [(f, o) for f in sorted(focal) for o in sorted(outer)
+                 if (f, o) not in done and f in lineages and o in lineages]
+        if(not pairs):
+            return
+
+        # A lineage ends in the current taxid of its taxon, which differs
+        # from the looked up taxid if that was merged into another taxon
+        lca = LCA(list(lineages.values()))
+        mrca = [lca(lineages[f][-1], lineages[o][-1]) for f, o in pairs]
+        if(__has_taxonomy__(cur, args)):
+            names.update(taxid2sciname(cur, mrca))
+        cols = ('focal_taxid', 'outer_taxid', 'mrca_taxid', 'phylostratum', 'mrca_name')
+        cur.executemany(misc.insert_cmd('MRCA', cols),
+                        ((f, o, m, lca.depth[m], names.get(m, str(m)))
+                         for (f, o), m in zip(pairs, mrca)))
+    con.close()
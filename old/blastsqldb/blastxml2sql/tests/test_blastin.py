@@ -0,0 +1,81 @@
+#! /usr/bin/python3
+
+import unittest
+
+from util import DatabaseTest, run
+
+COLUMNS = "qaccver saccver pident length mismatch gapopen qstart qend sstart send evalue bitscore"
+
+OUTFMT6 = '\n'.join((
+    "NP_1.1\tXP_1.1\t90.0\t50\t5\t0\t1\t50\t1\t50\t1e-20\t150.0",
+    "NP_1.1\tXP_1.1\t80.0\t20\t4\t0\t60\t79\t60\t79\t1e-5\t40.0",
+    "NP_1.1\tXP_2.1\t50.0\t40\t20\t0\t1\t40\t5\t44\t1e-3\t30.0",
+    "NP_2.1\tXP_3.1\t100.0\t10\t0\t0\t1\t10\t1\t10\t1e-2\t20.0",
+)) + '\n'
+
+# outfmt 7 without query column, as from -outfmt '7 sacc pident ...'
+OUTFMT7 = '\n'.join((
+    "# BLASTP 2.2.28+",
+    "# Query: NP_1.1 protein one",
+    "# Database: /data/Species_1.faa",
+    "# Fields: subject acc., % identity, alignment length, q. start, q. end, "
+    "s. start, s. end, evalue, bit score",
+    "# 2 hits found",
+    "XP_1\t90.0\t50\t1\t50\t1\t50\t1e-20\t150.0",
+    "XP_2\t50.0\t40\t1\t40\t5\t44\t1e-3\t30.0",
+    "# BLASTP 2.2.28+",
+    "# Query: NP_2.1 protein two",
+    "# Database: /data/Species_1.faa",
+    "# 0 hits found",
+    "# BLASTP 2.2.28+",
+    "# Query: NP_3.1 protein three",
+    "# Database: /data/Species_1.faa",
+    "# Fields: subject acc., % identity, alignment length, q. start, q. end, "
+    "s. start, s. end, evalue, bit score",
+    "# 1 hits found",
+    "XP_1\t70.0\t30\t1\t30\t1\t30\t1e-8\t60.0",
+)) + '\n'
+
+HITS = """
+    SELECT Iteration.query_ID, Iteration.query_def, Hit.num, Subject.id, Subject.accession,
+           count(Hsp.sid)
+    FROM Iteration
+    LEFT JOIN Hit ON Hit.parent = Iteration.sid
+    LEFT JOIN Subject ON Hit.subject = Subject.sid
+    LEFT JOIN Hsp ON Hsp.parent = Hit.sid
+    GROUP BY Iteration.sid, Hit.sid ORDER BY Iteration.iter_num, Hit.num
+    """
+
+class TabularTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        run('init', '-b', self.db)
+
+    def test_accession_columns(self):
+        report = self.write('r.tab', OUTFMT6)
+        run('blast', '-f', 'tab', '--columns', COLUMNS, '--database', 'Species_1.faa',
+            '-i', report, self.db)
+        self.assertEqual(self.fetch(HITS), [
+            ('NP_1.1', 'NP_1.1', 1, 'XP_1.1', 'XP_1.1', 2),
+            ('NP_1.1', 'NP_1.1', 2, 'XP_2.1', 'XP_2.1', 1),
+            ('NP_2.1', 'NP_2.1', 1, 'XP_3.1', 'XP_3.1', 1)])
+
+    def test_query_from_comment(self):
+        report = self.write('r.tab', OUTFMT7)
+        run('blast', '-f', 'tab', '-i', report, self.db)
+        self.assertEqual(self.fetch(HITS), [
+            ('NP_1.1', 'NP_1.1 protein one', 1, 'XP_1', 'XP_1', 1),
+            ('NP_1.1', 'NP_1.1 protein one', 2, 'XP_2', 'XP_2', 1),
+            ('NP_2.1', 'NP_2.1 protein two', None, None, None, 0),
+            ('NP_3.1', 'NP_3.1 protein three', 1, 'XP_1', 'XP_1', 1)])
+        self.assertEqual(self.fetch("SELECT db FROM BlastOutput"), [('/data/Species_1.faa',)])
+
+    def test_no_query(self):
+        report = self.write('r.tab', "XP_1\t150.0\n")
+        with self.assertRaises(AssertionError) as e:
+            run('blast', '-f', 'tab', '--columns', 'sacc bitscore', '--database', 'x',
+                '-i', report, self.db)
+        self.assertIn("No query field", str(e.exception))
+
+if __name__ == '__main__':
+    unittest.main()
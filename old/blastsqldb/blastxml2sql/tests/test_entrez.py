@@ -0,0 +1,97 @@
+#! /usr/bin/python3
+
+import http.server
+import threading
+import unittest
+import urllib.parse
+
+from util import DatabaseTest, blast_xml, run
+
+# A small taxonomy: 1 > 10 > 20 > (30, 40). Taxon 35 was merged into 30.
+PARENT = {10: 1, 20: 10, 30: 20, 40: 20}
+MERGED = {35: 30}
+NAMES = {1: 'root', 10: 'Clade ten', 20: 'Clade twenty', 30: 'Species thirty',
+         40: 'Species forty'}
+
+def __taxon__(taxid):
+    lineage = []
+    parent = PARENT[taxid]
+    while(parent != 1):
+        lineage.insert(0, parent)
+        parent = PARENT[parent]
+    out = ['<Taxon><TaxId>{}</TaxId>'.format(taxid),
+           '<ScientificName>{}</ScientificName><LineageEx>'.format(NAMES[taxid]),
+           '<Taxon><TaxId>1</TaxId><ScientificName>root</ScientificName></Taxon>']
+    out += ['<Taxon><TaxId>{}</TaxId><ScientificName>{}</ScientificName></Taxon>'.format(
+            t, NAMES[t]) for t in lineage]
+    out += ['</LineageEx><AkaTaxIds>']
+    out += ['<TaxId>{}</TaxId>'.format(a) for a, t in MERGED.items() if t == taxid]
+    out += ['</AkaTaxIds></Taxon>']
+    return(''.join(out))
+
+# Answers efetch by GET and esearch by POST only, as used by sqltools.entrez
+class EutilsStub(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def __reply__(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if(not url.path.endswith('efetch.fcgi')):
+            return(self.__reply__(405, ''))
+        ids = urllib.parse.parse_qs(url.query)['id'][0].split(',')
+        current = {MERGED.get(int(i), int(i)) for i in ids}
+        self.__reply__(200, '<TaxaSet>' + ''.join(
+            __taxon__(t) for t in sorted(current) if t in PARENT) + '</TaxaSet>')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        term = urllib.parse.parse_qs(body)['term'][0]
+        names = [x.split('"')[1] for x in term.split(' OR ')]
+        ids = [t for t, n in NAMES.items() if n in names]
+        self.__reply__(200, '<eSearchResult><IdList>' + ''.join(
+            '<Id>{}</Id>'.format(i) for i in ids) + '</IdList></eSearchResult>')
+
+class EntrezTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EutilsStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.entrez = ('--entrez',
+                       '--entrez_url', 'http://127.0.0.1:{}/'.format(self.server.server_port),
+                       '--cache', self.path('cache'))
+        run('init', '-b', '-d', '-m', self.db)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        DatabaseTest.tearDown(self)
+
+    def test_dbinfo_searches_names(self):
+        report = self.write('r.xml', blast_xml('/data/Species_forty.faa', (
+            ('query_1', (('XP_1', 150.0),)),)))
+        run('blast', '-i', report, self.db)
+        run('taxonomy', 'dbinfo', *self.entrez + (self.db,))
+        self.assertEqual(self.fetch("SELECT * FROM BlastDatabase"),
+                         [('Species_forty.faa', 40, 'Species forty')])
+
+    # The query taxid 35 is only known as an alias of 30
+    def test_mrca_of_merged_taxid(self):
+        report = self.write('r.xml', blast_xml('/data/Species_forty.faa', (
+            ('query_1', (('XP_1', 150.0),)),)))
+        run('blast', '-q', 35, '-i', report, self.db)
+        run('meta', self.db, input="database;taxid;species\nSpecies_forty.faa;40;Species forty\n")
+        run('taxonomy', 'mrca', *self.entrez + (self.db,))
+        self.assertEqual(self.fetch("SELECT * FROM MRCA ORDER BY focal_taxid, outer_taxid"),
+                         [(35, 40, 20, 2, 'Clade twenty')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#! /usr/bin/python3
+
+import sqlite3 as sql
+import unittest
+
+from util import DatabaseTest, blast_xml, needs_numpy, run
+
+@needs_numpy
+class PhylostrataTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        run('init', '-b', '-d', '-m', self.db)
+        report = self.write('r.xml', blast_xml('/data/Species_1.faa', (
+            ('query_1', (('XP_1', 150.0),)),
+            ('query_2', (('XP_2', 50.0),)))))
+        run('blast', '-q', 1, '-i', report, self.db)
+        con = sql.connect(self.db)
+        with con:
+            con.executemany("INSERT INTO MRCA VALUES(?, ?, ?, ?, ?)",
+                            ((1, 2, 10, 3, 'clade_3'), (1, 5, 20, 1, 'clade_1')))
+        con.close()
+
+    def meta(self, text):
+        run('meta', self.db, input='database;taxid;species\n' + text)
+
+    def test_database_by_file_name(self):
+        self.meta("Species_1.faa;2;species 2\n")
+        out = run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.assertEqual(out, "query_1,3\nquery_2,NA\n")
+
+    # A database listed under both its path and its file name is matched
+    # once, through the row holding the path
+    def test_path_preferred_to_file_name(self):
+        self.meta("Species_1.faa;2;species 2\n/data/Species_1.faa;5;species 5\n")
+        out = run('retrieval', 'phylostrata', '-s', 0, self.db)
+        self.assertEqual(out, "query_1,1\nquery_2,1\n")
+        self.assertEqual(self.fetch("SELECT count(*) FROM QueryStratum"), [(2,)])
+
+    def test_init_database_drops_strata(self):
+        self.meta("Species_1.faa;2;species 2\n")
+        run('retrieval', 'phylostrata', '-s', 100, self.db)
+        run('init', '-d', self.db)
+        self.assertEqual(self.fetch("SELECT count(*) FROM QueryStratum"), [(0,)])
+        self.meta("Species_1.faa;5;species 5\n")
+        out = run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.assertEqual(out, "query_1,1\nquery_2,NA\n")
+
+    def test_meta_taxid_change_drops_strata(self):
+        self.meta("Species_1.faa;2;species 2\n")
+        run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.meta("Species_1.faa;5;species 5\n")
+        out = run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.assertEqual(out, "query_1,1\nquery_2,NA\n")
+
+    # Adding the path of a database listed by file name changes its match
+    def test_meta_path_added_drops_strata(self):
+        self.meta("Species_1.faa;2;species 2\n")
+        run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.meta("/data/Species_1.faa;5;species 5\n")
+        out = run('retrieval', 'phylostrata', '-s', 100, self.db)
+        self.assertEqual(out, "query_1,1\nquery_2,NA\n")
+
+if __name__ == '__main__':
+    unittest.main()
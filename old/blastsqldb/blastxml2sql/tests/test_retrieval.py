@@ -0,0 +1,43 @@
+#! /usr/bin/python3
+
+import json
+import unittest
+
+from util import DatabaseTest, blast_xml, needs_numpy, numpy, run
+
+JOIN = ("SELECT Iteration.sid, Iteration.query_def, Hit.sid, Hit.num FROM Iteration " +
+        "INNER JOIN Hit ON Hit.parent = Iteration.sid ORDER BY Hit.sid")
+
+class RawTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        run('init', '-b', self.db)
+        report = self.write('r.xml', blast_xml('/data/Species_1.faa', (
+            ('query_1', (('XP_1', 150.0), ('XP_2', 50.0))),
+            ('query_2', (('XP_3', 20.0),)))))
+        run('blast', '-i', report, self.db)
+
+    def test_csv(self):
+        out = run('retrieval', 'raw', JOIN, self.db)
+        self.assertEqual(out.splitlines(), [
+            'sid,query_def,sid,num', '1,query_1,1,1', '1,query_1,2,2', '2,query_2,3,1'])
+
+    # Repeated column names of a join are kept apart
+    def test_json_join(self):
+        out = run('retrieval', 'raw', '-f', 'json', JOIN, self.db)
+        self.assertEqual([json.loads(line) for line in out.splitlines()], [
+            {'sid': 1, 'query_def': 'query_1', 'sid_': 1, 'num': 1},
+            {'sid': 1, 'query_def': 'query_1', 'sid_': 2, 'num': 2},
+            {'sid': 2, 'query_def': 'query_2', 'sid_': 3, 'num': 1}])
+
+    @needs_numpy
+    def test_npz_join(self):
+        output = self.path('out.npz')
+        run('retrieval', 'raw', '-f', 'npz', '-o', output, JOIN, self.db)
+        with numpy.load(output) as npz:
+            self.assertEqual(sorted(npz.files), ['num', 'query_def', 'sid', 'sid_'])
+            self.assertEqual(npz['sid_'].tolist(), [1, 2, 3])
+            self.assertEqual(npz['query_def'].tolist(), ['query_1', 'query_1', 'query_2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#! /usr/bin/python3
+
+# Helpers for the command line tests: each test builds a small database in a
+# temporary directory by running blastxml2sql.py, as a user would
+
+import os
+import os.path
+import sqlite3 as sql
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'blastxml2sql.py')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+needs_numpy = unittest.skipIf(numpy is None, "numpy is not installed")
+
+# Runs blastxml2sql.py, fails the test on a non-zero exit status and returns
+# stdout
+def run(*args, input=None):
+    args = tuple(map(str, args))
+    proc = subprocess.run((sys.executable, SCRIPT) + args,
+                          input=input, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if(proc.returncode != 0):
+        raise AssertionError("{} exited with {}:\n{}".format(
+            ' '.join(args), proc.returncode, proc.stdout + proc.stderr))
+    return(proc.stdout)
+
+# A BLAST XML report against db. Each query is a (query_def, hits) pair and
+# each hit an (accession, bit_score) pair with a single hsp.
+def blast_xml(db, queries):
+    out = ['<?xml version="1.0"?>', '<BlastOutput>',
+           '<BlastOutput_program>blastp</BlastOutput_program>',
+           '<BlastOutput_version>BLASTP 2.2.28+</BlastOutput_version>',
+           '<BlastOutput_reference>ref</BlastOutput_reference>',
+           '<BlastOutput_db>{}</BlastOutput_db>'.format(db),
+           '<BlastOutput_query-ID>Query_1</BlastOutput_query-ID>',
+           '<BlastOutput_query-def>{}</BlastOutput_query-def>'.format(queries[0][0]),
+           '<BlastOutput_query-len>100</BlastOutput_query-len>',
+           '<BlastOutput_param><Parameters>',
+           '<Parameters_matrix>BLOSUM62</Parameters_matrix>',
+           '<Parameters_expect>10</Parameters_expect>',
+           '<Parameters_gap-open>11</Parameters_gap-open>',
+           '<Parameters_gap-extend>1</Parameters_gap-extend>',
+           '<Parameters_filter>F</Parameters_filter>',
+           '</Parameters></BlastOutput_param>',
+           '<BlastOutput_iterations>']
+    for i, (query, hits) in enumerate(queries):
+        out += ['<Iteration>',
+                '<Iteration_iter-num>{}</Iteration_iter-num>'.format(i + 1),
+                '<Iteration_query-ID>Query_{}</Iteration_query-ID>'.format(i + 1),
+                '<Iteration_query-def>{}</Iteration_query-def>'.format(query),
+                '<Iteration_query-len>100</Iteration_query-len>',
+                '<Iteration_hits>']
+        for j, (accession, score) in enumerate(hits):
+            out += ['<Hit>',
+                    '<Hit_num>{}</Hit_num>'.format(j + 1),
+                    '<Hit_id>gi|{}</Hit_id>'.format(accession),
+                    '<Hit_def>{} protein</Hit_def>'.format(accession),
+                    '<Hit_accession>{}</Hit_accession>'.format(accession),
+                    '<Hit_len>100</Hit_len>',
+                    '<Hit_hsps><Hsp>',
+                    '<Hsp_num>1</Hsp_num>',
+                    '<Hsp_bit-score>{}</Hsp_bit-score>'.format(score),
+                    '<Hsp_score>{}</Hsp_score>'.format(int(score * 2)),
+                    '<Hsp_evalue>1e-10</Hsp_evalue>',
+                    '<Hsp_query-from>1</Hsp_query-from>',
+                    '<Hsp_query-to>50</Hsp_query-to>',
+                    '<Hsp_hit-from>1</Hsp_hit-from>',
+                    '<Hsp_hit-to>50</Hsp_hit-to>',
+                    '<Hsp_query-frame>0</Hsp_query-frame>',
+                    '<Hsp_hit-frame>0</Hsp_hit-frame>',
+                    '<Hsp_identity>40</Hsp_identity>',
+                    '<Hsp_positive>45</Hsp_positive>',
+                    '<Hsp_gaps>0</Hsp_gaps>',
+                    '<Hsp_align-len>50</Hsp_align-len>',
+                    '</Hsp></Hit_hsps>',
+                    '</Hit>']
+        out += ['</Iteration_hits>',
+                '<Iteration_stat><Statistics>',
+                '<Statistics_db-num>1000</Statistics_db-num>',
+                '<Statistics_db-len>300000</Statistics_db-len>',
+                '<Statistics_hsp-len>20</Statistics_hsp-len>',
+                '<Statistics_eff-space>20000000</Statistics_eff-space>',
+                '<Statistics_kappa>0.041</Statistics_kappa>',
+                '<Statistics_lambda>0.267</Statistics_lambda>',
+                '<Statistics_entropy>0.14</Statistics_entropy>',
+                '</Statistics></Iteration_stat>',
+                '</Iteration>']
+    out += ['</BlastOutput_iterations>', '</BlastOutput>']
+    return('\n'.join(out) + '\n')
+
+# A temporary directory holding an empty database, db.sqlite
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = self.path('db.sqlite')
+        open(self.db, 'w').close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return(os.path.join(self.tmp.name, name))
+
+    def write(self, name, text):
+        with open(self.path(name), 'w') as f:
+            f.write(text)
+        return(self.path(name))
+
+    def fetch(self, cmd, param=()):
+        con = sql.connect(self.db)
+        rows = con.execute(cmd, param).fetchall()
+        con.close()
+        return(rows)
@@ -1,5 +1,6 @@
 #! /usr/bin/python3
 
+import bisect
 import re
 import sys
 from collections import defaultdict
@@ -139,7 +140,7 @@ def update_besthits(cur, verbose=False):
                 total_val = total[key][field]
                 print("\t{}: {} {}".format(field, path_val, total_val))
 
-    best = _calculate_besthits(dat, cutoff=20)
+    best = _calculate_besthits(dat)
 
     dic = defaultdict(list)
     for pair in best['path']:
@@ -206,101 +207,78 @@ def _void_taxid(name):
             name, taxid = (None, None)
     return((name, taxid))
 
-def _calculate_besthits(d, cutoff=20, tosum=['gaps', 'pos', 'ident', 'score']):
+def _calculate_besthits(d, tosum=['gaps', 'pos', 'ident', 'score'], hit_overlap=True):
     """ \
     Arguments:
-        d      - data strucutre from update_besthits method
-        cutoff - hsp count above which the approximate score algorithm
-            will be used
+        d           - data strucutre from update_besthits method
+        hit_overlap - if False, the HSPs of a path may overlap neither on the
+            query nor on the hit, otherwise only the query is checked
     """
-    # Functions used for calculating optiml paths
-    def _avg_val(hsps):
-        # An approximated score is produced by multiplying the total
-        # alignment length by the average score per aligned character
-        # Other values (e.g. positive, identical, gaps) are dealt with
-        # similarly
-
-        # This sorting step is essential to the algorithm
-        # that calculates the non-overlapping alignment length
-        hsps = sorted(hsps, key=lambda x: x['qfrom'])
-
-        # Number of query characters that are aligned against at least
-        # one HSPs
-        alen = 0
-
-        # Beginning of query alignment
-        qfrom = hsps[0]['qfrom']
-
-        # End of query alignment
-        qto = hsps[0]['qto']
-
-        # The true alignment length is found be combining all overlapping
-        # segments and then summing their lengths
-        sum_fields = defaultdict(int)
-        for i in range(1, len(hsps)):
-            for field in tosum:
-                sum_fields[field] += hsps[i][field]
-            if(hsps[i]['qfrom'] <= qto):
-                qto = max(hsps[i]['qto'], qto)
-            else:
-                alen += qto - qfrom + 1
-                qfrom, qto = hsps[i]['qfrom'], hsps[i]['qto']
-        alen += qto - qfrom + 1
-
-        # Summed length of all HSPs
-        tlen = sum([x['qto'] - x['qfrom'] + 1 for x in hsps])
-
-        avg_fields = {k:((v / tlen) * alen) for k,v in sum_fields.items()}
-        avg_fields['alen'] = alen
-
-        return(avg_fields)
-
-    # Otherwise initialize an algorithm to search all possible paths
-    # through the directed acyclic graph of non-overlapping subsequences
-    # (HSPs) with weights equal to the bitscores. I will use a very crude
-    # bruteforce algorithm. The time could be improved with a bit of branch
-    # pruning. It also might be worthwhile to implement this is C and
-    # optimize the hell out of it.
-    # More importantly, this algorithm ensures a path with no overlaps in
-    # query sequence, however it still allows overlaps in hits. This should
-    # be remedied.
-    def _bestpath(v, end=-1, s=0, p=[]):
-        scores = []
-        eol = True
-        for i in range(len(v)):
-            nv = v[0:i] + v[(i+1):]
-            if(v[i]['qfrom'] > end):
-                eol = False
-                scores.append(_bestpath(
-                    nv,
-                    v[i]['qto'],
-                    s + v[i]['score'],
-                    p + [v[i]['hsp']]))
-        if(eol):
-            return((s,p))
+    # Find the highest scoring chain of HSPs that do not overlap on the query
+    # (and, optionally, are also ordered and non-overlapping on the hit). This is
+    # weighted interval scheduling on a DAG: HSPs are visited in order of
+    # query start, each one is appended to the best chain among the HSPs that
+    # end before it begins. Ended HSPs are stored in a Fenwick tree indexed by
+    # their hit end, so the best compatible predecessor is a prefix maximum.
+    # The whole search is O(n log n).
+    def _bestpath(v):
+        n = len(v)
+        qspan = [(min(x['qfrom'], x['qto']), max(x['qfrom'], x['qto'])) for x in v]
+        hspan = [(min(x['hfrom'], x['hto']), max(x['hfrom'], x['hto'])) for x in v]
+
+        # Rank of each hit end, only the ordering matters
+        if(hit_overlap):
+            hend = [1] * n
         else:
-            return(max(scores))
-
-    def _global_val(hsps):
-        # If there is only one HSP, simply return the single HSPs relevant
-        # values. In biological cases, the number of HSPs very often is 0 or 1.
-
-        path = _bestpath(hsps)
-        out = {}
-        for field in tosum:
-            out[field] = sum(hsps[i-1][field] for i in path[1])
-            out['alen'] = sum([hsps[i-1]['qto'] - hsps[i-1]['qfrom'] + 1 for i in path[1]])
-        out['nhsp'] = len(hsps)
-        return(out)
+            ends = sorted(set(h[1] for h in hspan))
+            hend = [bisect.bisect_left(ends, h[1]) + 1 for h in hspan]
+        size = max(hend)
+
+        # Fenwick tree of (score, index) prefix maxima over hit end ranks
+        tree = [(0, -1)] * (size + 1)
+        def _update(i, val):
+            while(i <= size):
+                if(val > tree[i]): tree[i] = val
+                i += i & (-i)
+        def _query(i):
+            best = (0, -1)
+            while(i > 0):
+                if(tree[i] > best): best = tree[i]
+                i -= i & (-i)
+            return(best)
+
+        by_start = sorted(range(n), key=lambda i: qspan[i][0])
+        by_end = sorted(range(n), key=lambda i: qspan[i][1])
+        score = [0] * n
+        prev = [-1] * n
+        k = 0
+        for j in by_start:
+            # Make every HSP that ends before j begins available
+            while(k < n and qspan[by_end[k]][1] < qspan[j][0]):
+                i = by_end[k]
+                _update(hend[i], (score[i], i))
+                k += 1
+            if(hit_overlap):
+                s, i = _query(size)
+            else:
+                # Ranks of hit ends strictly below j's hit start
+                s, i = _query(bisect.bisect_left(ends, hspan[j][0]))
+            score[j] = s + v[j]['score']
+            prev[j] = i
+
+        best = max(range(n), key=lambda i: score[i])
+        path = []
+        while(best >= 0):
+            path.append(best)
+            best = prev[best]
+        path.reverse()
+        return((score[path[-1]], path))
 
-    # The _global_val function is very slow for large numbers of hsps, so the
-    # approximating function, _avg_val, will be called when size is above
-    # the given cutoff
     def _path(hsps):
-        if(len(hsps) <= cutoff):
-            out = _global_val(hsps)
-        else:
-            out = _avg_val(hsps)
+        path = [hsps[i] for i in _bestpath(hsps)[1]]
+        out = {k:sum([x[k] for x in path]) for k in tosum}
+        out['alen'] = sum([x['qto'] - x['qfrom'] + 1 for x in path])
+        out['nhsp'] = len(hsps)
         return(out)
 
     # Straight sum of all hsps summable values